@@ -1,18 +1,78 @@
 import os
+import asyncio
 import logging
+import time
 import json
 import re
 from openai import AsyncOpenAI
 import config
+import compaction
+import intent_rules
+import metrics
+import tokens
+from cache import AsyncTTLCache
+from llm_scheduler import LLMScheduler
 
 # --- НАСТРОЙКИ ---
 # Инициализация клиента
 client = AsyncOpenAI(
     base_url="https://api.groq.com/openai/v1",
-    api_key=config.GROQ_API_KEY
+    api_key=config.GROQ_API_KEY,
+    max_retries=0  # повторы делает планировщик
 )
 
-GROQ_MODEL = "llama-3.3-70b-versatile"
+# Все запросы к модели идут через планировщик: лимиты RPM/TPM, приоритеты, ретраи
+llm = LLMScheduler(
+    client,
+    rpm=config.LLM_RPM,
+    tpm=config.LLM_TPM,
+    max_concurrency=config.LLM_MAX_CONCURRENCY,
+    max_retries=config.LLM_MAX_RETRIES,
+    backoff_base=config.LLM_BACKOFF_BASE,
+    backoff_max=config.LLM_BACKOFF_MAX,
+    default_output_tokens=config.LLM_DEFAULT_OUTPUT_TOKENS,
+)
+
+async def _request(on_delta=None, **kwargs):
+    if on_delta is None:
+        response = await llm.create(**kwargs)
+        return response.choices[0].message.content or ""
+    parts = []
+    async for delta in llm.stream(**kwargs):
+        parts.append(delta)
+        await on_delta("".join(parts))
+    return "".join(parts)
+
+async def _complete(route, on_delta=None, **kwargs):
+    """
+    Текст ответа модели для маршрута из config.LLM_ROUTES: модель, max_tokens
+    и таймаут берутся оттуда. Если основная модель так и не ответила, один
+    раз пробуем запасную.
+    С on_delta ответ идет потоком: после каждого кусочка вызывается
+    await on_delta(весь текст на данный момент).
+    """
+    settings = config.LLM_ROUTES[route]
+    models = [settings["model"]] + ([settings["fallback"]] if settings["fallback"] else [])
+    for i, model in enumerate(models):
+        started = time.perf_counter()
+        try:
+            text = await _request(
+                on_delta,
+                model=model,
+                max_tokens=settings["max_tokens"],
+                timeout=settings["timeout"],
+                **kwargs
+            )
+        except Exception as e:
+            metrics.incr(f"llm.route.{route}.failed")
+            if i == len(models) - 1:
+                raise
+            logging.warning(f"LLM route {route}: {model} failed ({e}), trying {models[i + 1]}")
+            metrics.incr(f"llm.route.{route}.fallback")
+            continue
+        metrics.observe(f"llm.route.{route}", time.perf_counter() - started)
+        metrics.incr(f"llm.route.{route}.ok")
+        return text
 
 # --- 1. МОЗГ: ОПРЕДЕЛЕНИЕ НАМЕРЕНИЙ (ROUTER) ---
 
@@ -51,41 +111,85 @@ INTENT_SYSTEM_PROMPT = """
 - {"action": "chat"}
 """
 
+async def _detect_intent_llm(user_text: str) -> dict:
+    """Запрос к LLM-роутеру. Ошибки пробрасываются, чтобы не попасть в кэш."""
+    result_text = await _complete(
+        "intent",
+        messages=[
+            {"role": "system", "content": INTENT_SYSTEM_PROMPT},
+            {"role": "user", "content": f"User Input: {user_text}"}
+        ],
+        temperature=0.1, # Минимальная температура для точности JSON
+        response_format={"type": "json_object"}
+    )
+    
+    # Парсинг JSON
+    result_text = result_text.strip()
+    return _normalize_intent(json.loads(result_text))
+
+def _normalize_intent(intent_data: dict) -> dict:
+    # Защита от отсутствия полей
+    if "action" not in intent_data:
+        intent_data["action"] = "chat"
+        
+    # Нормализация данных
+    if intent_data["action"] == "search":
+        intent_data.setdefault("keywords", "")
+        intent_data.setdefault("username", None)
+    elif intent_data["action"] in ["summary", "analytics"]:
+        intent_data.setdefault("timeframe", "1d")
+        
+    return intent_data
+
+# Кэш решений роутера: в группах одни и те же фразы ("новости?", "итоги дня")
+# повторяются постоянно, а при temperature=0.1 ответ и так почти детерминирован.
+intent_cache = AsyncTTLCache(maxsize=config.INTENT_CACHE_SIZE, ttl=config.INTENT_CACHE_TTL)
+
+def _intent_cache_key(user_text: str) -> str:
+    """Регистр, ё/е, пунктуация и лишние пробелы на намерение не влияют."""
+    text = user_text.lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w\s@]", " ", text).split())
+
 async def detect_intent(user_text: str) -> dict:
     """Определяет, что делать с сообщением."""
     try:
-        response = await client.chat.completions.create(
-            model=GROQ_MODEL,
-            messages=[
-                {"role": "system", "content": INTENT_SYSTEM_PROMPT},
-                {"role": "user", "content": f"User Input: {user_text}"}
-            ],
-            temperature=0.1, # Минимальная температура для точности JSON
-            max_tokens=200,
-            response_format={"type": "json_object"}
+        intent_data = await intent_cache.get_or_compute(
+            _intent_cache_key(user_text),
+            lambda: _detect_intent_llm(user_text)
         )
-        
-        # Парсинг JSON
-        result_text = response.choices[0].message.content.strip()
-        intent_data = json.loads(result_text)
-        
-        # Защита от отсутствия полей
-        if "action" not in intent_data:
-            return {"action": "chat"}
-            
-        # Нормализация данных
-        if intent_data["action"] == "search":
-            intent_data.setdefault("keywords", "")
-            intent_data.setdefault("username", None)
-        elif intent_data["action"] in ["summary", "analytics"]:
-            intent_data.setdefault("timeframe", "1d")
-            
-        return intent_data
+        return dict(intent_data) # Копия: вызывающий код может менять словарь
 
     except Exception as e:
         logging.error(f"Intent Error: {e}")
         return {"action": "chat"} # Если сломалось — просто болтаем
 
+_UNCLASSIFIED = object()
+
+async def route_intent(user_text: str, context: str = None, username: str = None, fast_intent=_UNCLASSIFIED, bot_username: str = None) -> dict:
+    """
+    Сначала локальные правила, LLM-роутер — только для неоднозначных фраз.
+    fast_intent — уже посчитанный intent_rules.classify(user_text) (в том
+    числе None), чтобы не прогонять правила повторно. bot_username — свой
+    @username бота: упоминание бота — не автор для поиска.
+    При config.COMBINED_ROUTING роутер заодно отвечает как личность: для
+    chat/info в результате уже есть should_reply и reply_text.
+    Поле "source" ("rules" / "llm" / "combined") — откуда решение.
+    """
+    if fast_intent is _UNCLASSIFIED:
+        intent = intent_rules.classify_counted(user_text, bot_username)
+    else:
+        intent = intent_rules.record(fast_intent)
+    if intent is not None:
+        intent["source"] = "rules"
+        return intent
+    if config.COMBINED_ROUTING:
+        intent = await route_and_reply(user_text, context=context, username=username)
+        intent["source"] = "combined"
+        return intent
+    intent = await detect_intent(user_text)
+    intent["source"] = "llm"
+    return intent
+
 # --- 2. ЛИЧНОСТЬ: БЕТОН (CHAT MODE) ---
 
 PERSONA_SYSTEM_PROMPT = """
@@ -134,31 +238,103 @@ async def analyze_and_reply(user_text: str, context: str = None, username: str =
             {"role": "user", "content": f"{stats_info}\nCONTEXT: {context or 'No context'}\n\nINCOMING MESSAGE from {user_display}:\n\"{user_text}\""}
         ]
 
-        response = await client.chat.completions.create(
-            model=GROQ_MODEL,
+        result_text = await _complete(
+            "persona",
             messages=prompt_messages,
             temperature=0.7, # Чуть ниже для стабильности, но достаточно для креатива
-            max_tokens=600,
             response_format={"type": "json_object"}
         )
 
-        result = json.loads(response.choices[0].message.content)
-        
-        # Усиливаем желание ответить, если это вопрос
-        if "?" in user_text and "should_reply" in result and not result["should_reply"]:
-             # Если есть вопросительный знак, лучше ответить, чем промолчать
-             result["should_reply"] = True
-
-        # Страховка полей
-        if "should_reply" not in result: result["should_reply"] = True 
-        if "reply_text" not in result: result["reply_text"] = "Мои нейросети задумались..."
-        
-        return result
+        result = json.loads(result_text)
+        return _normalize_reply(result, user_text)
 
     except Exception as e:
         logging.error(f"Persona Error: {e}")
         return {"should_reply": False, "reply_text": None}
 
+def _normalize_reply(result: dict, user_text: str) -> dict:
+    # Усиливаем желание ответить, если это вопрос
+    if "?" in user_text and "should_reply" in result and not result["should_reply"]:
+         # Если есть вопросительный знак, лучше ответить, чем промолчать
+         result["should_reply"] = True
+
+    # Страховка полей
+    if "should_reply" not in result: result["should_reply"] = True 
+    if "reply_text" not in result: result["reply_text"] = "Мои нейросети задумались..."
+    
+    return result
+
+async def generate_conversation_starter(recent_rows: list, silence_minutes: int) -> str:
+    """
+    Реплика, которой Бетон сам нарушает тишину в чате.
+    recent_rows — последние сообщения (username, text, created_at), старые первыми.
+    None, если персона решила промолчать или модель не ответила.
+    """
+    try:
+        history = "\n".join(f"{user or 'Unknown'}: {text}" for user, text, _ in recent_rows)
+        prompt_messages = [
+            {"role": "system", "content": PERSONA_SYSTEM_PROMPT},
+            {"role": "user", "content": (
+                f"[SYSTEM EVENT] В чате тишина уже {silence_minutes} мин. Никто к тебе не обращался.\n"
+                f"Последние сообщения:\n{history or 'Пусто'}\n\n"
+                "Начни разговор сам: короткая живая реплика, вопрос или подкол, "
+                "лучше по теме последних сообщений. Если сказать нечего — should_reply: false."
+            )}
+        ]
+        result_text = await _complete(
+            "persona",
+            messages=prompt_messages,
+            temperature=0.9,
+            response_format={"type": "json_object"}
+        )
+        result = json.loads(result_text)
+        if not result.get("should_reply", True):
+            return None
+        return result.get("reply_text") or None
+
+    except Exception as e:
+        logging.error(f"Starter Error: {e}")
+        return None
+
+# --- 2.5. РОУТЕР + ЛИЧНОСТЬ ЗА ОДИН ЗАПРОС (COMBINED MODE) ---
+
+COMBINED_SYSTEM_PROMPT = f"""
+{PERSONA_SYSTEM_PROMPT}
+
+ДОПОЛНИТЕЛЬНО ты сам решаешь, что делать с сообщением, как Логическое Ядро:
+{INTENT_SYSTEM_PROMPT}
+
+ИТОГОВЫЙ ФОРМАТ — ОДИН JSON, объединяющий оба решения:
+- Для search / summary / analytics: только поля маршрутизации (action, keywords, username, timeframe). Ответ не пиши — его сделает следующий модуль по данным из базы.
+- Для chat / info: поле action и сразу твой ответ: "should_reply" (boolean), "reply_text" (string).
+Пример: {{"action": "info", "should_reply": true, "reply_text": "Я — Бетон..."}}
+"""
+
+async def route_and_reply(user_text: str, context: str = None, username: str = None) -> dict:
+    """
+    Один запрос вместо detect_intent + analyze_and_reply: решение роутера и,
+    для chat/info, готовый ответ личности.
+    """
+    user_display = f"User: @{username}" if username else "User: Unknown Bio-unit"
+    try:
+        result_text = await _complete(
+            "combined",
+            messages=[
+                {"role": "system", "content": COMBINED_SYSTEM_PROMPT},
+                {"role": "user", "content": f"CONTEXT: {context or 'No context'}\n\nINCOMING MESSAGE from {user_display}:\n\"{user_text}\""}
+            ],
+            temperature=0.6,
+            response_format={"type": "json_object"}
+        )
+        result = _normalize_intent(json.loads(result_text))
+        if result["action"] in ["chat", "info"]:
+            _normalize_reply(result, user_text)
+        return result
+
+    except Exception as e:
+        logging.error(f"Combined Router Error: {e}")
+        return {"action": "chat", "should_reply": False, "reply_text": None}
+
 # --- 3. АНАЛИТИК: ПОИСК И ОТВЕТЫ (SEARCH MODE) ---
 
 SEARCH_SYSTEM_PROMPT = """
@@ -172,13 +348,18 @@ SEARCH_SYSTEM_PROMPT = """
 4. СТРУКТУРИРУЙ ОТВЕТ: Если много инфы — используй пункты.
 """
 
-async def answer_search_query(user_question: str, found_messages: list = None, context_text: str = None) -> str:
+async def answer_search_query(user_question: str, found_messages: list = None, context_text: str = None, on_delta=None) -> str:
     # Подготовка данных для промпта
     data_block = ""
     if context_text:
         data_block = f"--- КОНТЕКСТ (Пересланное/Реплаи) ---\n{context_text}\n"
     
     if found_messages:
+        # Дубли и пустые реакции выкидываем; ссылки целиком — их могли и искать,
+        # а найденные сообщения не склеиваем — они идут по релевантности, не подряд
+        compactor = compaction.Compactor(config.COMPACT_DEDUPE_WINDOW, 0, shorten_urls=False)
+        found_messages = [out for row in found_messages for out in compactor.feed(row)] + compactor.flush()
+        compactor.report("search")
         msgs_str = "\n".join([f"[{dt}] {usr}: {txt}" for usr, txt, dt in found_messages])
         data_block += f"--- НАЙДЕННЫЕ СООБЩЕНИЯ В БАЗЕ ---\n{msgs_str}"
     
@@ -186,16 +367,15 @@ async def answer_search_query(user_question: str, found_messages: list = None, c
         return "📂 Мои жесткие диски пусты по этому запросу. Никаких данных."
 
     try:
-        response = await client.chat.completions.create(
-            model=GROQ_MODEL,
+        return await _complete(
+            "search",
+            on_delta,
             messages=[
                 {"role": "system", "content": SEARCH_SYSTEM_PROMPT},
                 {"role": "user", "content": f"ЗАПРОС ПОЛЬЗОВАТЕЛЯ: {user_question}\n\n{data_block}"}
             ],
-            temperature=0.3,
-            max_tokens=1000
+            temperature=0.3
         )
-        return response.choices[0].message.content
     except Exception:
         return "⚠️ Ошибка модуля аналитики."
 
@@ -213,48 +393,239 @@ SUMMARY_SYSTEM_PROMPT = """
 🤖 **Вердикт Бетона:** (Твой саркастичный комментарий о продуктивности кожаных мешков)
 """
 
-MAX_CHARS = 12000 # Чуть уменьшил для безопасности
+# Бюджет куска в токенах: окно модели минус системный промпт и место под ответ
+CHUNK_TOKENS = (
+    config.SUMMARY_CONTEXT_TOKENS
+    - tokens.estimate_tokens(SUMMARY_SYSTEM_PROMPT)
+    - config.LLM_ROUTES["summary_map"]["max_tokens"]
+    - config.SUMMARY_HEADROOM_TOKENS
+)
 
-async def summarize_chunk(text):
-    """Сжимает кусок текста"""
+async def summarize_chunk(text, on_delta=None):
+    """Сжимает кусок текста. Ошибки API пробрасываются наверх."""
+    return await _complete(
+        "summary_map",
+        on_delta,
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"LOG:\n{text}"}
+        ],
+        temperature=0.4
+    )
+
+async def merge_summaries(summaries, on_delta=None):
+    """Склеивает частичные отчеты в один. Ошибки API пробрасываются наверх."""
+    final_text = "\n\n".join(summaries)
+    return await _complete(
+        "summary_reduce",
+        on_delta,
+        messages=[
+            {"role": "system", "content": "Объедини эти отчеты в один связный финальный отчет в стиле робота Бетона."},
+            {"role": "user", "content": final_text}
+        ]
+    )
+
+async def _with_retry(call, *args):
+    """call(*args) с config.SUMMARY_RETRIES повторами. None, если все попытки упали."""
+    for attempt in range(config.SUMMARY_RETRIES + 1):
+        try:
+            return await call(*args)
+        except Exception as e:
+            logging.warning(f"{call.__name__} failed (attempt {attempt + 1}): {e}")
+            if attempt < config.SUMMARY_RETRIES:
+                await asyncio.sleep(config.SUMMARY_RETRY_DELAY * (attempt + 1))
+    return None
+
+async def map_chunks(chunks):
+    """
+    MAP: сжимает куски параллельно, не больше config.SUMMARY_CONCURRENCY
+    запросов одновременно. chunks — асинхронный поток: следующий кусок
+    собирается только когда освободился слот, поэтому в памяти лежат лишь
+    куски, которые сейчас в работе.
+    Возвращает (summaries, failed): частичные отчеты по порядку и число
+    кусков, которые не удалось сжать.
+    """
+    slots = asyncio.Semaphore(config.SUMMARY_CONCURRENCY)
+
+    async def run(chunk):
+        try:
+            return await _with_retry(summarize_chunk, chunk)
+        finally:
+            slots.release()
+
+    chunks = chunks.__aiter__()
+    tasks = []
     try:
-        response = await client.chat.completions.create(
-            model=GROQ_MODEL,
-            messages=[
-                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
-                {"role": "user", "content": f"LOG:\n{text}"}
-            ],
-            temperature=0.4
-        )
-        return response.choices[0].message.content
-    except Exception:
-        return ""
-
-async def summarize_chat(chat_text):
+        while True:
+            # Сначала слот, потом следующий кусок
+            await slots.acquire()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                slots.release()
+                break
+            tasks.append(asyncio.create_task(run(chunk)))
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    summaries = [res for res in results if res]
+    return summaries, len(results) - len(summaries)
+
+async def reduce_summaries(summaries, on_delta=None):
+    """
+    REDUCE деревом: склеивает отчеты группами по config.SUMMARY_REDUCE_FANIN,
+    пока не останется один. Так ни одна склейка не вылезает за контекст.
+    Если склейка группы упала, группа идет дальше как есть.
+    Последняя склейка идет потоком в on_delta, если он задан.
+    """
+    fanin = max(2, config.SUMMARY_REDUCE_FANIN)
+    slots = asyncio.Semaphore(config.SUMMARY_CONCURRENCY)
+
+    async def merge(group, on_delta=None):
+        if len(group) == 1:
+            return group
+        async with slots:
+            merged = await _with_retry(merge_summaries, group, on_delta)
+        return [merged] if merged else group
+
+    while len(summaries) > 1:
+        groups = [summaries[i:i + fanin] for i in range(0, len(summaries), fanin)]
+        final = on_delta if len(groups) == 1 else None
+        merged = await asyncio.gather(*(merge(group, final) for group in groups))
+        reduced = [summary for group in merged for summary in group]
+        if len(reduced) == len(summaries):
+            # Ни одна склейка не прошла — дальше пытаться бессмысленно
+            logging.error("Summary reduce made no progress, returning partial reports")
+            return "\n\n".join(reduced)
+        summaries = reduced
+    return summaries[0]
+
+def failure_note(failed, total, unit="кусков истории"):
+    return f"\n\n⚠️ Не удалось обработать {failed} из {total} {unit} — сводка может быть неполной."
+
+async def _chain(head, rest):
+    for item in head:
+        yield item
+    async for item in rest:
+        yield item
+
+SUMMARY_FAILED = "Мои нейросети не смогли переварить эту историю. Попробуй позже."
+
+async def _summarize_stream(chunks, on_delta=None):
+    """
+    map + reduce над потоком кусков. Возвращает (сводка, полная ли она);
+    сводка None, если кусков не было. Неполные сводки и отказы не кешируются.
+    Итоговый запрос (единственный кусок или последняя склейка) идет в on_delta.
+    """
+    chunks = chunks.__aiter__()
+    head = []
+    async for chunk in chunks:
+        head.append(chunk)
+        if len(head) == 2:
+            break
+    if len(head) == 1:
+        # Один кусок: его сжатие и есть итог, его и стримим
+        result = await _with_retry(summarize_chunk, head[0], on_delta)
+        return (result, True) if result else (SUMMARY_FAILED, False)
+
+    summaries, failed = await map_chunks(_chain(head, chunks))
+    total = len(summaries) + failed
+    if total == 0:
+        return None, True
+    if not summaries:
+        return SUMMARY_FAILED, False
+    result = await reduce_summaries(summaries, on_delta)
+    if failed:
+        result += failure_note(failed, total)
+    return result, failed == 0
+
+async def digest_messages(rows):
+    """
+    Отчет по потоку сообщений для кеша сводок (см. rolling_summary).
+    Возвращает (отчет, полный ли он). Отчет None, если сообщений не было
+    или ни один кусок не сжался; неполные отчеты не кешируются.
+    """
+    summaries, failed = await map_chunks(chunk_rows(rows))
+    if not summaries:
+        return None, failed == 0
+    return await reduce_summaries(summaries), failed == 0
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+async def summarize_chat(chat_text, on_delta=None):
     """Главная функция суммаризации"""
     if not chat_text: return "Данных для анализа нет. Тишина."
     
-    # Если текст короткий - сразу в модель
-    if len(chat_text) < MAX_CHARS:
-        return await summarize_chunk(chat_text)
-    
-    # Если длинный - режем на куски (простая реализация)
-    chunks = [chat_text[i:i+MAX_CHARS] for i in range(0, len(chat_text), MAX_CHARS)]
-    summaries = []
-    for chunk in chunks:
-        res = await summarize_chunk(chunk)
-        if res: summaries.append(res)
-    
-    # Финальная склейка
-    final_text = "\n\n".join(summaries)
-    try:
-        final_res = await client.chat.completions.create(
-            model=GROQ_MODEL,
-            messages=[
-                {"role": "system", "content": "Объедини эти отчеты в один связный финальный отчет в стиле робота Бетона."},
-                {"role": "user", "content": final_text}
-            ]
-        )
-        return final_res.choices[0].message.content
-    except:
-        return "Ошибка при склейке отчетов."
\ No newline at end of file
+    # Строки "user: text" проходят компакцию и режутся в пределах бюджета
+    # токенов, короткий текст — один кусок
+    rows = []
+    for line in chat_text.splitlines():
+        user, sep, text = line.partition(": ")
+        rows.append((user, text, None) if sep else (None, line, None))
+    summary, _ = await _summarize_stream(chunk_rows(_iterate(rows)), on_delta)
+    return summary
+
+async def chunk_lines(lines, max_tokens=None):
+    """
+    Пакует целые строки из асинхронного потока в куски до max_tokens
+    (по умолчанию CHUNK_TOKENS). Строки не режутся; строка, которая одна
+    не влезает в кусок, выбрасывается. В памяти держится только текущий кусок.
+    """
+    max_tokens = max_tokens or CHUNK_TOKENS
+    chunk = []
+    size = 0
+    dropped = 0
+    async for line in lines:
+        cost = tokens.estimate_tokens(line) + 1  # +1 за перенос строки
+        if cost > max_tokens:
+            dropped += 1
+            continue
+        if chunk and size + cost > max_tokens:
+            yield "\n".join(chunk)
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += cost
+    if chunk:
+        yield "\n".join(chunk)
+    if dropped:
+        logging.warning(f"Summary: dropped {dropped} oversized messages")
+        metrics.incr("summary.dropped_messages", dropped)
+
+async def compact_rows(rows):
+    """
+    Поток строк (username, text, created_at) после компакции: без флуда,
+    дублей и длинных ссылок, подряд идущие сообщения автора склеены.
+    В конце пишет в лог, сколько токенов сэкономлено.
+    """
+    compactor = compaction.Compactor(config.COMPACT_DEDUPE_WINDOW, config.COMPACT_MAX_MERGED_CHARS)
+    async for row in rows:
+        for out in compactor.feed(row):
+            yield out
+    for out in compactor.flush():
+        yield out
+    compactor.report("summary")
+
+async def chunk_rows(rows, max_tokens=None):
+    """
+    Куски "user: text" из потока строк (username, text, created_at)
+    db.iter_messages, по границам сообщений, после компакции.
+    """
+    async def lines():
+        async for user, text, _ in compact_rows(rows):
+            yield f"{user}: {text}" if user is not None else text
+
+    async for chunk in chunk_lines(lines(), max_tokens):
+        yield chunk
+
+async def summarize_messages(rows, on_delta=None):
+    """
+    Суммаризация потока сообщений без загрузки всей истории в память:
+    куски сжимаются параллельно по мере набора, потом склеиваются деревом.
+    Возвращает (сводка, полная ли она); сводка None, если сообщений не было.
+    """
+    return await _summarize_stream(chunk_rows(rows), on_delta)
@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import config
+
+# Polling vs webhook ingestion on one machine. A fake Telegram Bot API
+# server stands in for api.telegram.org: it answers getMe / setWebhook /
+# deleteWebhook, serves queued updates to getUpdates, and accepts any other
+# method. Every chat gets the "mention" reply policy, so no LLM is called
+# and the measured path is update delivery, parsing, logging and gating.
+#
+#   python bench_ingest.py --mode polling --updates 5000
+#   python bench_ingest.py --mode webhook --updates 5000 --concurrency 64
+
+FAKE_API_PORT = 8181
+BOT_ID = 1000
+BOT_USERNAME = "beton_bench_bot"
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.offset = 0
+        self.new_updates = asyncio.Event()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Beton", "username": BOT_USERNAME}
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        # Everything below offset is confirmed by the client
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def push(self, updates):
+        self.updates.extend(updates)
+        self.new_updates.set()
+
+
+def make_updates(count, chats):
+    now = int(time.time())
+    return [
+        {
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": now,
+                "chat": {"id": -1000 - i % chats, "type": "supergroup", "title": f"bench {i % chats}"},
+                "from": {"id": 10 + i % 97, "is_bot": False, "first_name": "u", "username": f"user{i % 97}"},
+                "text": f"обычное сообщение номер {i}",
+            },
+        }
+        for i in range(count)
+    ]
+
+
+async def wait_logged(db, count):
+    while db.hot_tier.stats()["messages"] < count:
+        await asyncio.sleep(0.01)
+
+
+async def post_updates(updates, concurrency):
+    url = f"http://127.0.0.1:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": config.WEBHOOK_SECRET}
+    pending = iter(updates)
+    acks = []
+
+    async def sender(session):
+        for update in pending:
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                assert response.status == 200, response.status
+            acks.append(time.perf_counter() - started)
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    return sorted(acks)
+
+
+async def run(args):
+    config.DB_NAME = os.path.join(tempfile.mkdtemp(), "bench.db")
+    config.BOT_MODE = args.mode
+    config.WEBHOOK_URL = ""
+    config.WEBHOOK_HOST = "127.0.0.1"
+    config.WEBHOOK_SECRET = "bench-secret"
+    config.HOT_TIER_MAX_PER_CHAT = max(config.HOT_TIER_MAX_PER_CHAT, args.updates)
+
+    import bot
+    import db
+    bot.gate.default_policy = "mention"
+
+    fake = FakeTelegram()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", FAKE_API_PORT).start()
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{FAKE_API_PORT}"))
+    config.TELEGRAM_BOT_TOKEN = config.TELEGRAM_BOT_TOKEN or "1000:bench"
+    main_task = asyncio.create_task(bot.main(session=session))
+    await asyncio.sleep(1.0)  # startup: migrations, getMe, server / first poll
+
+    updates = make_updates(args.updates, args.chats)
+    started = time.perf_counter()
+    acks = None
+    if args.mode == "webhook":
+        acks = await post_updates(updates, args.concurrency)
+    else:
+        fake.push(updates)
+    await wait_logged(db, args.updates)
+    elapsed = time.perf_counter() - started
+
+    print(f"mode={args.mode} updates={args.updates} chats={args.chats}")
+    print(f"all logged in {elapsed:.2f}s, {args.updates / elapsed:.0f} updates/s")
+    if acks:
+        print(f"webhook ack p50={acks[len(acks) // 2] * 1000:.1f}ms p95={acks[int(len(acks) * 0.95)] * 1000:.1f}ms")
+
+    if args.mode == "polling":
+        await bot.dispatcher.stop_polling()
+    else:
+        main_task.cancel()
+    await asyncio.gather(main_task, return_exceptions=True)
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare polling and webhook ingestion against a fake Telegram")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="webhook")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=32, help="parallel webhook senders")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import metrics
+
+# Per-chat ordered work queues served by a fixed pool of workers.
+#
+# Chats take turns: a worker serves one job of a chat and puts the chat
+# back at the end of the ready line, so a flood in one chat cannot starve
+# the others, and jobs of one chat never run concurrently or out of order.
+#
+# Job kinds and overload policy:
+#   command - explicit commands and requests (/summary, "итоги дня"):
+#             never merged, never dropped
+#   chat    - chat-mode replies: a new message joins a still-waiting chat
+#             job of the same chat (one reply to the whole burst); old and
+#             excess chat jobs are shed when the chat falls behind
+#
+# Ordering: handlers run as concurrent tasks (webhook), so they can reach
+# submit() out of update order, and commands match earlier in the router.
+# Jobs submitted with an order key (the Telegram message_id) are kept
+# sorted by it among the waiting jobs of the chat. A job that already
+# started is not preempted, so ordering holds only from submission on.
+
+COMMAND = "command"
+CHAT = "chat"
+
+
+class _Job:
+    __slots__ = ("kind", "handler", "payloads", "order", "queued_at", "updated_at")
+
+    def __init__(self, kind, handler, payload, order):
+        self.kind = kind
+        self.handler = handler
+        self.payloads = [payload]
+        self.order = order
+        self.queued_at = self.updated_at = time.monotonic()
+
+
+class ChatQueue:
+    def __init__(self, workers, max_pending_per_chat, chat_max_age):
+        self.workers = workers
+        self.max_pending_per_chat = max_pending_per_chat
+        self.chat_max_age = chat_max_age
+        self._chats = {}  # chat_id -> deque of _Job waiting
+        self._ready = asyncio.Queue()  # chats with waiting jobs and nothing running
+        self._busy = set()  # chats with a job running or in the ready line
+        self._tasks = []
+
+    def submit(self, chat_id, kind, handler, payload, order=None):
+        """
+        Queue await handler(payloads) for a chat. payloads is the list of
+        payloads merged into the job (just [payload] unless merged).
+        order (e.g. message_id) places the job before waiting jobs with a
+        greater order; jobs without one go to the end.
+        """
+        jobs = self._chats.setdefault(chat_id, deque())
+        position = len(jobs)
+        if order is not None:
+            while position > 0 and jobs[position - 1].order is not None and jobs[position - 1].order > order:
+                position -= 1
+        if position == len(jobs) and kind == CHAT and jobs and jobs[-1].kind == CHAT and jobs[-1].handler is handler:
+            jobs[-1].payloads.append(payload)
+            jobs[-1].order = order if order is not None else jobs[-1].order
+            jobs[-1].updated_at = time.monotonic()
+            metrics.incr("chat_queue.merged")
+        else:
+            if position != len(jobs):
+                metrics.incr("chat_queue.reordered")
+            jobs.insert(position, _Job(kind, handler, payload, order))
+            self._shed_excess(jobs)
+        metrics.incr("chat_queue.submitted")
+        if chat_id not in self._busy:
+            self._busy.add(chat_id)
+            self._ready.put_nowait(chat_id)
+        self._record_depth()
+
+    def _shed_excess(self, jobs):
+        # Oldest chat jobs go first; commands stay even over the limit
+        excess = len(jobs) - self.max_pending_per_chat
+        for job in list(jobs):
+            if excess <= 0:
+                break
+            if job.kind == CHAT:
+                jobs.remove(job)
+                excess -= 1
+                metrics.incr("chat_queue.shed", len(job.payloads))
+
+    def _record_depth(self):
+        metrics.gauge("chat_queue.pending", sum(len(jobs) for jobs in self._chats.values()))
+        metrics.gauge("chat_queue.chats", len(self._busy))
+
+    def _next_job(self, chat_id):
+        jobs = self._chats.get(chat_id)
+        while jobs:
+            job = jobs.popleft()
+            if job.kind == CHAT and time.monotonic() - job.updated_at > self.chat_max_age:
+                # Nobody waits for a reply to chatter this old
+                metrics.incr("chat_queue.shed", len(job.payloads))
+                continue
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            job = self._next_job(chat_id)
+            if job is not None:
+                metrics.observe(f"chat_queue.wait.{job.kind}", time.monotonic() - job.queued_at)
+                try:
+                    await job.handler(job.payloads)
+                except Exception as e:
+                    logging.error(f"Chat job failed in {chat_id}: {e}")
+            if self._chats.get(chat_id):
+                # Back to the end of the line: round robin across chats
+                self._ready.put_nowait(chat_id)
+            else:
+                self._chats.pop(chat_id, None)
+                self._busy.discard(chat_id)
+            self._record_depth()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "chats": len(self._busy),
+            "pending": sum(len(jobs) for jobs in self._chats.values()),
+            "workers": len(self._tasks),
+        }
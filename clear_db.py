@@ -7,6 +7,10 @@ async def clear_db():
     async with aiosqlite.connect(config.DB_NAME) as db:
         print("Deleting all messages...")
         await db.execute("DELETE FROM messages")
+        await db.execute("DELETE FROM activity_hourly")
+        await db.execute("DELETE FROM activity_daily")
+        await db.execute("DELETE FROM summary_buckets")
+        await db.execute("DELETE FROM chat_activity")
         await db.commit()
         print("Vacuuming database...")
         await db.execute("VACUUM")
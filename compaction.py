@@ -0,0 +1,109 @@
+import logging
+import re
+from collections import OrderedDict
+
+import metrics
+from tokens import estimate_tokens
+
+# Shrinks chat logs before they are sent to the model: floods of "+",
+# emoji-only reactions, repeated forwards and long tracking URLs cost
+# tokens and add nothing to a summary. Rows keep the (username, text,
+# created_at) shape of db.iter_messages, so the stage slots in front of
+# any consumer.
+
+_URL = re.compile(r"https?://(?:www\.)?([^\s/?#:]+)[^\s]*", re.IGNORECASE)
+_HAS_CONTENT = re.compile(r"[^\W_]")  # any letter or digit
+_REPEATS = re.compile(r"(\S)\1{3,}")  # "ааааааа", "!!!!!!", "😂😂😂😂"
+_SPACES = re.compile(r"\s+")
+_NON_WORD = re.compile(r"[\W_]+")
+
+# Key length used to detect near-duplicates
+_DEDUPE_KEY_CHARS = 200
+
+
+def compact_text(text, shorten_urls=True):
+    """Cleaned message text, or "" if nothing meaningful is left."""
+    if shorten_urls:
+        text = _URL.sub(r"[\1]", text)
+    text = _REPEATS.sub(r"\1\1\1", text)
+    text = _SPACES.sub(" ", text).strip()
+    if not _HAS_CONTENT.search(text):
+        return ""
+    return text
+
+
+def _dedupe_key(text):
+    # Case, punctuation, emoji and spacing don't make a message different
+    return _NON_WORD.sub(" ", text.lower()).strip()[:_DEDUPE_KEY_CHARS]
+
+
+class Compactor:
+    """
+    Row-by-row compaction with a small state: the last few hundred message
+    keys for de-duplication and the run of consecutive messages of the
+    current author, which is emitted as one row (texts joined with " / ").
+    """
+
+    def __init__(self, dedupe_window, max_merged_chars, shorten_urls=True):
+        self.dedupe_window = dedupe_window
+        self.max_merged_chars = max_merged_chars
+        self.shorten_urls = shorten_urls
+        self.rows_in = 0
+        self.rows_out = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self._seen = OrderedDict()
+        self._run = None  # [username, [texts], created_at, length]
+
+    def feed(self, row):
+        """Take one row; returns the rows that became final (0 or 1)."""
+        username, text, created_at = row
+        self.rows_in += 1
+        self.tokens_in += estimate_tokens(f"{username}: {text}") + 1
+
+        text = compact_text(text or "", self.shorten_urls)
+        if not text:
+            return []
+        key = _dedupe_key(text)
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return []
+        self._seen[key] = None
+        if len(self._seen) > self.dedupe_window:
+            self._seen.popitem(last=False)
+
+        run = self._run
+        # Users without an @username all come as None: never one author
+        if (
+            run is not None and username is not None and run[0] == username
+            and run[3] + len(text) <= self.max_merged_chars
+        ):
+            run[1].append(text)
+            run[3] += len(text) + 3
+            return []
+        out = self.flush()
+        self._run = [username, [text], created_at, len(text)]
+        return out
+
+    def flush(self):
+        """Emit the pending run of the current author, if any."""
+        if self._run is None:
+            return []
+        username, texts, created_at, _ = self._run
+        self._run = None
+        row = (username, " / ".join(texts), created_at)
+        self.rows_out += 1
+        self.tokens_out += estimate_tokens(f"{row[0]}: {row[1]}") + 1
+        return [row]
+
+    def report(self, label):
+        saved = self.tokens_in - self.tokens_out
+        metrics.incr("compaction.tokens_in", self.tokens_in)
+        metrics.incr("compaction.tokens_saved", saved)
+        if self.rows_in:
+            logging.info(
+                f"Compaction ({label}): {self.rows_in} -> {self.rows_out} rows, "
+                f"~{self.tokens_in} -> ~{self.tokens_out} tokens, saved ~{saved} "
+                f"({saved * 100 // max(self.tokens_in, 1)}%)"
+            )
+        return saved
@@ -4,9 +4,135 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+
+# "polling" (getUpdates) or "webhook" (aiohttp server, see bot.run_webhook)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public https base; empty = don't register the webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token
+
+# Multi-process mode (sharding.py): > 1 runs a supervisor and this many
+# shard processes, chats split by abs(chat_id) % SHARDS, one DB file each
+SHARDS = int(os.getenv("SHARDS", "1"))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "10000"))  # updates buffered per shard
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")  # Kept for backward compatibility
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")  # New: Groq API key
 DB_NAME = "chat_history.db"
 
+# SQLite connection pool: one writer plus a few readers (WAL mode)
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", "500"))  # rows per page in db.iter_messages
+
+# Write-behind message log: flush after this many rows or seconds
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "200"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_MAX_PENDING = int(os.getenv("LOG_MAX_PENDING", "50000"))
+
+# In-memory tier of recent messages per chat (hot_tier.py)
+HOT_TIER_MAX_PER_CHAT = int(os.getenv("HOT_TIER_MAX_PER_CHAT", "2000"))
+HOT_TIER_MAX_AGE = int(os.getenv("HOT_TIER_MAX_AGE", str(24 * 3600)))  # seconds
+HOT_TIER_MAX_BYTES = int(os.getenv("HOT_TIER_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Search: "keyword" (FTS5), "semantic" (local vectors) or "hybrid" (both)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+SEARCH_RRF_K = 60  # reciprocal rank fusion constant for hybrid mode
+SEMANTIC_DIM = int(os.getenv("SEMANTIC_DIM", "256"))
+SEMANTIC_MAX_ROWS = int(os.getenv("SEMANTIC_MAX_ROWS", "20000"))  # newest messages indexed per chat
+SEMANTIC_MAX_CHATS = int(os.getenv("SEMANTIC_MAX_CHATS", "8"))  # chats kept loaded
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.1"))
+
+# Cache of LLM intent decisions, keyed by normalized text
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "2048"))
+INTENT_CACHE_TTL = int(os.getenv("INTENT_CACHE_TTL", "600"))  # seconds
+
+# Per-route LLM settings: model, output budget (max_tokens), timeout in
+# seconds and a fallback model tried once when the main one keeps failing.
+# Each field can be overridden with LLM_<ROUTE>_<FIELD>, e.g.
+# LLM_INTENT_MODEL=llama-3.1-8b-instant; an empty fallback disables it.
+LLM_MODEL = os.getenv("LLM_MODEL", "llama-3.3-70b-versatile")
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "llama-3.1-8b-instant")
+_LLM_ROUTE_DEFAULTS = {
+    # route: (model, max_tokens, timeout, fallback)
+    "intent": (LLM_FAST_MODEL, 200, 10, LLM_MODEL),
+    "persona": (LLM_MODEL, 600, 30, LLM_FAST_MODEL),
+    "combined": (LLM_MODEL, 600, 30, LLM_FAST_MODEL),
+    "search": (LLM_MODEL, 1000, 45, LLM_FAST_MODEL),
+    "summary_map": (LLM_MODEL, 1024, 60, LLM_FAST_MODEL),
+    "summary_reduce": (LLM_MODEL, 1500, 90, LLM_FAST_MODEL),
+}
+LLM_ROUTES = {
+    route: {
+        "model": os.getenv(f"LLM_{route.upper()}_MODEL", model),
+        "max_tokens": int(os.getenv(f"LLM_{route.upper()}_MAX_TOKENS", str(max_tokens))),
+        "timeout": float(os.getenv(f"LLM_{route.upper()}_TIMEOUT", str(timeout))),
+        "fallback": os.getenv(f"LLM_{route.upper()}_FALLBACK", fallback) or None,
+    }
+    for route, (model, max_tokens, timeout, fallback) in _LLM_ROUTE_DEFAULTS.items()
+}
+
+# Summary / analytics results shared by identical requests in a chat (bot.request_cache)
+REQUEST_CACHE_SIZE = int(os.getenv("REQUEST_CACHE_SIZE", "256"))
+REQUEST_CACHE_TTL = int(os.getenv("REQUEST_CACHE_TTL", "180"))  # seconds
+
+# Streamed answers: minimum seconds between edits of the message being written
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# LLM scheduler (llm_scheduler.py): provider limits and retry policy
+LLM_RPM = int(os.getenv("LLM_RPM", "30"))  # requests per minute
+LLM_TPM = int(os.getenv("LLM_TPM", "12000"))  # tokens per minute
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))  # seconds
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30.0"))
+LLM_DEFAULT_OUTPUT_TOKENS = int(os.getenv("LLM_DEFAULT_OUTPUT_TOKENS", "1024"))  # budgeted when max_tokens isn't set
+
+# Summarization: parallel map over chunks, then a tree reduce
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))  # LLM calls in flight
+SUMMARY_REDUCE_FANIN = int(os.getenv("SUMMARY_REDUCE_FANIN", "4"))  # reports per merge
+SUMMARY_RETRIES = int(os.getenv("SUMMARY_RETRIES", "1"))
+SUMMARY_RETRY_DELAY = float(os.getenv("SUMMARY_RETRY_DELAY", "1.0"))  # seconds
+# Token budget of one summary call; chunks get what is left after the
+# system prompt, the summary_map output budget and the headroom (estimates are rough)
+SUMMARY_CONTEXT_TOKENS = int(os.getenv("SUMMARY_CONTEXT_TOKENS", "6000"))
+SUMMARY_HEADROOM_TOKENS = int(os.getenv("SUMMARY_HEADROOM_TOKENS", "256"))
+# Windows with at most this many messages (about two chunks) are summarized
+# from raw messages in one pass instead of merging cached bucket digests
+SUMMARY_RAW_MAX_MESSAGES = int(os.getenv("SUMMARY_RAW_MAX_MESSAGES", "300"))
+
+# Chat log compaction before summaries / search answers (compaction.py)
+COMPACT_DEDUPE_WINDOW = int(os.getenv("COMPACT_DEDUPE_WINDOW", "500"))  # recent messages checked for duplicates
+COMPACT_MAX_MERGED_CHARS = int(os.getenv("COMPACT_MAX_MERGED_CHARS", "1500"))  # cap on one author's merged run
+
+# Relevance gate before the LLM (gating.py): reply policy per chat, one of
+# mention / keywords / sampled / all. GATE_CHAT_POLICIES="-100123:mention,-100456:all"
+GATE_DEFAULT_POLICY = os.getenv("GATE_DEFAULT_POLICY", "sampled")
+GATE_CHAT_POLICIES = {
+    int(chat_id): policy
+    for chat_id, policy in (
+        item.split(":") for item in os.getenv("GATE_CHAT_POLICIES", "").split(",") if item.strip()
+    )
+}
+GATE_SAMPLE_RATE = float(os.getenv("GATE_SAMPLE_RATE", "0.05"))  # share of chatter answered under "sampled"
+GATE_KEYWORDS = [k.strip() for k in os.getenv("GATE_KEYWORDS", "").split(",") if k.strip()]
+BOT_NAMES = [n.strip() for n in os.getenv("BOT_NAMES", "бетон,beton").split(",") if n.strip()]
+
+# Per-chat work queues (chat_queue.py): global worker pool and overload policy
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", "8"))
+CHAT_QUEUE_MAX_PENDING = int(os.getenv("CHAT_QUEUE_MAX_PENDING", "5"))  # waiting jobs per chat before chat-mode work is shed
+CHAT_QUEUE_MAX_AGE = float(os.getenv("CHAT_QUEUE_MAX_AGE", "120"))  # seconds a chat-mode reply may wait
+
+# Conversation starters in quiet group chats (silence.py); 0 turns them off
+SILENCE_THRESHOLD = int(os.getenv("SILENCE_THRESHOLD", "3600"))  # seconds without messages
+SILENCE_MAX_IDLE = int(os.getenv("SILENCE_MAX_IDLE", str(24 * 3600)))  # chats quiet longer at startup are left alone
+SILENCE_CONTEXT_MESSAGES = int(os.getenv("SILENCE_CONTEXT_MESSAGES", "15"))  # recent messages shown to the persona
+
+# One LLM call for routing + persona reply on chat/info (see ai_service.route_and_reply)
+COMBINED_ROUTING = os.getenv("COMBINED_ROUTING", "0") == "1"
+
 # Use system DejaVu font which we know exists and supports Cyrillic
 FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
@@ -1,115 +1,783 @@
+import asyncio
+import logging
+import re
+import time
 import aiosqlite
-from datetime import datetime, timedelta
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import timedelta
 import config
+from hot_tier import HotTier, format_ts
+from semantic_index import SemanticIndex, embed_many
 
-async def init_db():
-    async with aiosqlite.connect(config.DB_NAME) as db:
-        # Check if table exists and has chat_id
-        # For simplicity in this upgrade, we'll create if not exists, 
-        # but since we want to enforce the new schema, we might need to handle migration.
-        # Given the previous "delete all data" instruction, we can be a bit aggressive 
-        # but let's try to be safe: create table with new schema if it doesn't exist.
-        # If it exists without chat_id, it might fail on insert. 
-        # Ideally we'd check columns, but for this task let's assume we can recreate or the user handles it.
-        # Actually, let's just create it correctly.
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                user_id INTEGER,
-                username TEXT,
-                text TEXT,
-                reply_to_user_id INTEGER,
-                reply_to_username TEXT,
-                created_at DATETIME
-            )
-        """)
-        
-        # Migrations for existing tables
+# --- Connection pool ---
+# The connections are opened once in init_db() and reused by every query.
+# SQLite only ever allows one writer, so all writes go through a single
+# connection guarded by a lock; reads are spread over a small pool and
+# don't block the writer thanks to WAL.
+_writer = None
+_write_lock = None
+_readers = None  # asyncio.Queue with idle reader connections
+_reader_conns = []
+
+def _pragmas():
+    return (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA cache_size=-{config.DB_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size={config.DB_MMAP_SIZE}",
+        f"PRAGMA busy_timeout={config.DB_BUSY_TIMEOUT_MS}",
+    )
+
+async def _connect(read_only=False):
+    conn = await aiosqlite.connect(config.DB_NAME)
+    for pragma in _pragmas():
+        await conn.execute(pragma)
+    if read_only:
+        await conn.execute("PRAGMA query_only=ON")
+    return conn
+
+async def _open_pool():
+    global _writer, _write_lock, _readers, _reader_conns
+    if _writer is not None:
+        return
+    _writer = await _connect()
+    _write_lock = asyncio.Lock()
+    _readers = asyncio.Queue()
+    _reader_conns = []
+    for _ in range(max(1, config.DB_READ_POOL_SIZE)):
+        conn = await _connect(read_only=True)
+        _reader_conns.append(conn)
+        _readers.put_nowait(conn)
+
+async def close_db():
+    """
+    Flush the pending message log and close all pooled connections.
+    Safe to call more than once.
+    """
+    global _writer, _write_lock, _readers, _reader_conns
+    if _writer is None:
+        return
+    await _stop_flusher()
+    async with _write_lock:
+        for conn in _reader_conns:
+            await conn.close()
+        # Fold the WAL back into the main file so the .db is self-contained
+        await _writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        await _writer.close()
+    _writer = None
+    _write_lock = None
+    _readers = None
+    _reader_conns = []
+
+def _ensure_open():
+    if _writer is None:
+        raise RuntimeError("Database is not initialized, call db.init_db() first")
+
+@asynccontextmanager
+async def _read_conn():
+    _ensure_open()
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+@asynccontextmanager
+async def _write_transaction():
+    """
+    Exclusive access to the writer connection. Commits on success and
+    rolls back if the block raises.
+    """
+    _ensure_open()
+    async with _write_lock:
+        try:
+            yield _writer
+            await _writer.commit()
+        except BaseException:
+            await _writer.rollback()
+            raise
+
+# --- Write-behind message log ---
+# Handlers only append to _pending; a background task writes the rows with
+# one executemany() per transaction once LOG_BATCH_SIZE rows are queued or
+# LOG_FLUSH_INTERVAL seconds have passed, whichever comes first.
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (chat_id, user_id, text, reply_to_user_id, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# Authors: latest name wins, last_seen only moves forward
+UPSERT_AUTHOR_SQL = """
+    INSERT INTO users (user_id, username, last_seen) VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = COALESCE(excluded.username, users.username),
+        last_seen = MAX(COALESCE(users.last_seen, 0), excluded.last_seen)
+"""
+
+# Reply targets: we learn their name, but they weren't seen writing
+UPSERT_REPLY_TARGET_SQL = """
+    INSERT INTO users (user_id, username) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = COALESCE(excluded.username, users.username)
+"""
+
+# Activity rollups (see get_top_talkers): message counts per chat, user and
+# hour / day, bumped by every flushed batch
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+
+UPSERT_HOURLY_SQL = """
+    INSERT INTO activity_hourly (chat_id, hour, user_id, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, hour, user_id) DO UPDATE SET count = count + excluded.count
+"""
+
+UPSERT_DAILY_SQL = """
+    INSERT INTO activity_daily (chat_id, day, user_id, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, day, user_id) DO UPDATE SET count = count + excluded.count
+"""
+
+# Last message and Telegram chat type per chat, read back by the silence
+# scheduler after a restart
+UPSERT_CHAT_ACTIVITY_SQL = """
+    INSERT INTO chat_activity (chat_id, last_message_at, chat_type) VALUES (?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        last_message_at = MAX(last_message_at, excluded.last_message_at),
+        chat_type = COALESCE(excluded.chat_type, chat_activity.chat_type)
+"""
+
+# Late messages make a cached summary of their bucket stale
+DELETE_BUCKET_SUMMARY_SQL = """
+    DELETE FROM summary_buckets WHERE granularity = ? AND chat_id = ? AND bucket = ?
+"""
+
+_pending = []
+_flush_wakeup = None
+_flush_task = None
+
+# Recent messages per chat, served without touching SQLite (see hot_tier.py)
+hot_tier = HotTier(
+    max_per_chat=config.HOT_TIER_MAX_PER_CHAT,
+    max_age_seconds=config.HOT_TIER_MAX_AGE,
+    max_bytes=config.HOT_TIER_MAX_BYTES,
+)
+
+# Vector index for semantic search (see semantic_index.py and semantic_search)
+semantic = SemanticIndex(
+    dim=config.SEMANTIC_DIM,
+    max_rows_per_chat=config.SEMANTIC_MAX_ROWS,
+    max_chats=config.SEMANTIC_MAX_CHATS,
+)
+_semantic_locks = {}
+_semantic_backlog = {}  # chat_id -> rows written while the chat is being loaded
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def enqueue_message(chat_id, user_id, username, text, reply_to_user_id=None, reply_to_username=None, chat_type=None):
+    """
+    Queue a message for the next batched INSERT. Never blocks: the row
+    reaches the database within LOG_FLUSH_INTERVAL seconds.
+    """
+    created_at = _now_ms()
+    _pending.append((
+        chat_id,
+        user_id,
+        username,
+        text,
+        reply_to_user_id,
+        reply_to_username,
+        created_at,
+        chat_type
+    ))
+    hot_tier.add(chat_id, user_id, username, text, created_at)
+    if len(_pending) >= config.LOG_BATCH_SIZE and _flush_wakeup is not None:
+        _flush_wakeup.set()
+
+async def _write_batch(db, batch):
+    """
+    Store queued rows: names go to the users table once per user,
+    messages keep only ids and the epoch-ms timestamp.
+    """
+    authors = {}
+    reply_targets = {}
+    hourly = Counter()
+    daily = Counter()
+    last_activity = {}
+    for chat_id, user_id, username, text, reply_to_user_id, reply_to_username, created_at, chat_type in batch:
+        authors[user_id] = (user_id, username, created_at)
+        if reply_to_user_id is not None:
+            reply_targets[reply_to_user_id] = (reply_to_user_id, reply_to_username)
+        hourly[(chat_id, created_at // HOUR_MS, user_id)] += 1
+        daily[(chat_id, created_at // DAY_MS, user_id)] += 1
+        previous = last_activity.get(chat_id, (0, None))
+        last_activity[chat_id] = (max(created_at, previous[0]), chat_type or previous[1])
+
+    await db.executemany(UPSERT_REPLY_TARGET_SQL, reply_targets.values())
+    await db.executemany(UPSERT_AUTHOR_SQL, authors.values())
+    await db.executemany(INSERT_MESSAGE_SQL, [
+        (chat_id, user_id, text, reply_to_user_id, created_at)
+        for chat_id, user_id, _, text, reply_to_user_id, _, created_at, _ in batch
+    ])
+    await db.executemany(UPSERT_HOURLY_SQL, [key + (count,) for key, count in hourly.items()])
+    await db.executemany(UPSERT_DAILY_SQL, [key + (count,) for key, count in daily.items()])
+    # Late messages make a cached summary of their bucket stale; coarser
+    # digests are caught by their message count
+    touched = {("shift", chat_id, hour // 8) for chat_id, hour, _ in hourly}
+    touched.update(("day", chat_id, day) for chat_id, day, _ in daily)
+    await db.executemany(DELETE_BUCKET_SUMMARY_SQL, touched)
+    await db.executemany(UPSERT_CHAT_ACTIVITY_SQL, [
+        (chat_id, last_message_at, chat_type)
+        for chat_id, (last_message_at, chat_type) in last_activity.items()
+    ])
+
+def _index_semantic(batch):
+    # Runs after the batch is committed, off the handlers' path
+    for chat_id, user_id, username, text, _, _, created_at, _ in batch:
+        row = (created_at, user_id, username, text)
+        if chat_id in _semantic_backlog:
+            _semantic_backlog[chat_id].append(row)
+        else:
+            semantic.add(chat_id, row)
+
+async def flush_messages():
+    """
+    Write every queued message in a single transaction.
+    Returns the number of rows written.
+    """
+    global _pending
+    if not _pending:
+        return 0
+    batch, _pending = _pending, []
+    try:
+        async with _write_transaction() as db:
+            await _write_batch(db, batch)
+    except BaseException:
+        # Put the rows back for the next attempt, but don't grow forever
+        # if the database stays unavailable.
+        _pending = batch + _pending
+        overflow = len(_pending) - config.LOG_MAX_PENDING
+        if overflow > 0:
+            del _pending[:overflow]
+            logging.error(f"Message log overflow, dropped {overflow} oldest rows")
+        raise
+    _index_semantic(batch)
+    return len(batch)
+
+async def _flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), timeout=config.LOG_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
         try:
-            await db.execute("SELECT chat_id FROM messages LIMIT 1")
-        except Exception:
-            try:
-                await db.execute("ALTER TABLE messages ADD COLUMN chat_id INTEGER")
-            except Exception as e:
-                print(f"Migration warning (chat_id): {e}")
+            await flush_messages()
+        except Exception as e:
+            logging.error(f"Message log flush failed: {e}")
 
+def _start_flusher():
+    global _flush_wakeup, _flush_task
+    if _flush_task is not None:
+        return
+    _flush_wakeup = asyncio.Event()
+    _flush_task = asyncio.create_task(_flush_loop())
+
+async def _stop_flusher():
+    global _flush_wakeup, _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
         try:
-            await db.execute("SELECT reply_to_user_id FROM messages LIMIT 1")
-        except Exception:
-            try:
-                await db.execute("ALTER TABLE messages ADD COLUMN reply_to_user_id INTEGER")
-                await db.execute("ALTER TABLE messages ADD COLUMN reply_to_username TEXT")
-            except Exception as e:
-                print(f"Migration warning (reply_columns): {e}")
-                
-        await db.commit()
-
-async def log_message(chat_id, user_id, username, text, reply_to_user_id=None, reply_to_username=None):
-    async with aiosqlite.connect(config.DB_NAME) as db:
-        await db.execute("""
-            INSERT INTO messages (chat_id, user_id, username, text, reply_to_user_id, reply_to_username, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            chat_id,
-            user_id,
-            username,
-            text,
-            reply_to_user_id,
-            reply_to_username,
-            datetime.now()
-        ))
-        await db.commit()
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+        _flush_wakeup = None
+    try:
+        await flush_messages()
+    except Exception as e:
+        logging.error(f"Final message log flush failed, {len(_pending)} rows lost: {e}")
+
+# --- Full-text search ---
+# External-content FTS5 table: the index stores only tokens, the text itself
+# stays in messages. chat_id is indexed too so a search intersects the
+# posting lists of the chat and the query terms instead of filtering matches
+# from every chat. unicode61 folds Cyrillic case and diacritics (ё -> е).
+CREATE_FTS_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text,
+        chat_id,
+        content='messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+"""
+
+FTS_TRIGGERS_SQL = (
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, chat_id) VALUES (new.id, new.text, new.chat_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, chat_id) VALUES ('delete', old.id, old.text, old.chat_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, chat_id) VALUES ('delete', old.id, old.text, old.chat_id);
+        INSERT INTO messages_fts(rowid, text, chat_id) VALUES (new.id, new.text, new.chat_id);
+    END
+    """,
+)
+
+# Common Russian inflection endings. Stripping them and searching by prefix
+# lets "деплой" also find "деплоя" and "деплоем".
+_RU_ENDINGS = re.compile(
+    r"(иями|ями|ами|ого|его|ому|ему|ыми|ими|ая|яя|ое|ее|ие|ые|ой|ей|ий|ый|ам|ям|ах|ях|ом|ем|ов|ев|ую|юю|а|я|о|е|ы|и|у|ю|ь)$"
+)
+
+def _fts_query(query):
+    """
+    Turn free text into an FTS5 expression: every word becomes a quoted
+    prefix term, terms are OR-ed and bm25 ranks messages matching more of them.
+    Returns None if nothing searchable is left.
+    """
+    terms = []
+    for word in re.findall(r"\w+", query.lower()):
+        stem = _RU_ENDINGS.sub("", word)
+        if len(stem) < 4:
+            stem = word
+        if len(stem) < 2 or f'"{stem}"*' in terms:
+            continue
+        terms.append(f'"{stem}"*')
+    if not terms:
+        return None
+    return " OR ".join(terms)
+
+# --- Schema migrations ---
+# The schema version lives in PRAGMA user_version. Migration N brings the
+# database from version N-1 to N; each one runs in its own transaction and
+# init_db() only applies the ones that are missing, so a current database
+# starts without any probing.
+
+async def _migration_base_schema(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            text TEXT,
+            reply_to_user_id INTEGER,
+            reply_to_username TEXT,
+            created_at DATETIME
+        )
+    """)
+
+    # Archives from before chat_id / reply tracking existed
+    cursor = await db.execute("PRAGMA table_info(messages)")
+    columns = {row[1] for row in await cursor.fetchall()}
+    if "chat_id" not in columns:
+        await db.execute("ALTER TABLE messages ADD COLUMN chat_id INTEGER")
+    if "reply_to_user_id" not in columns:
+        await db.execute("ALTER TABLE messages ADD COLUMN reply_to_user_id INTEGER")
+    if "reply_to_username" not in columns:
+        await db.execute("ALTER TABLE messages ADD COLUMN reply_to_username TEXT")
+
+async def _migration_fts(db):
+    cursor = await db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    )
+    fts_exists = await cursor.fetchone() is not None
+    await db.execute(CREATE_FTS_SQL)
+    for trigger_sql in FTS_TRIGGERS_SQL:
+        await db.execute(trigger_sql)
+    if not fts_exists:
+        # Backfill an existing archive in one pass
+        await db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+async def _migration_time_indexes(db):
+    # get_messages / get_top_talkers / get_active_users filter on
+    # (chat_id, created_at); username makes the index covering for the
+    # GROUP BY / DISTINCT ones.
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_created
+        ON messages (chat_id, created_at, username)
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_user_created
+        ON messages (chat_id, user_id, created_at)
+    """)
+    await db.execute("ANALYZE messages")
+
+async def _migration_compact_storage(db):
+    # created_at becomes epoch milliseconds (integer compares, 8 bytes
+    # instead of a 26-char string) and usernames move to a users table.
+    # The old values are naive local-time ISO strings, hence 'utc'.
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            last_seen INTEGER
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE messages_compact (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER,
+            text TEXT,
+            reply_to_user_id INTEGER,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("""
+        INSERT INTO messages_compact (id, chat_id, user_id, text, reply_to_user_id, created_at)
+        SELECT id, COALESCE(chat_id, 0), user_id, text, reply_to_user_id,
+               COALESCE(CAST(ROUND((julianday(created_at, 'utc') - 2440587.5) * 86400000) AS INTEGER), 0)
+        FROM messages
+    """)
+    # Bare columns next to MAX() come from the row holding the maximum,
+    # i.e. the most recent name of each user
+    await db.execute("""
+        INSERT INTO users (user_id, username, last_seen)
+        SELECT m.user_id, o.username, MAX(m.created_at)
+        FROM messages_compact m JOIN messages o ON o.id = m.id
+        WHERE m.user_id IS NOT NULL
+        GROUP BY m.user_id
+    """)
+    await db.execute("""
+        INSERT OR IGNORE INTO users (user_id, username)
+        SELECT reply_to_user_id, reply_to_username FROM messages
+        WHERE reply_to_user_id IS NOT NULL
+        GROUP BY reply_to_user_id
+    """)
+
+    # Dropping the old table also drops its FTS triggers and indexes.
+    # Row ids and texts are unchanged, so messages_fts itself stays valid.
+    await db.execute("DROP TABLE messages")
+    await db.execute("ALTER TABLE messages_compact RENAME TO messages")
+    for trigger_sql in FTS_TRIGGERS_SQL:
+        await db.execute(trigger_sql)
+    await db.execute("""
+        CREATE INDEX idx_messages_chat_created
+        ON messages (chat_id, created_at, user_id)
+    """)
+    await db.execute("""
+        CREATE INDEX idx_messages_chat_user_created
+        ON messages (chat_id, user_id, created_at)
+    """)
+    await db.execute("ANALYZE")
+
+async def _migration_activity_rollups(db):
+    # Hour / day numbers are epoch-based (created_at // HOUR_MS, // DAY_MS)
+    for table, column, bucket_ms in (
+        ("activity_hourly", "hour", HOUR_MS),
+        ("activity_daily", "day", DAY_MS),
+    ):
+        await db.execute(f"""
+            CREATE TABLE {table} (
+                chat_id INTEGER NOT NULL,
+                {column} INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, {column}, user_id)
+            ) WITHOUT ROWID
+        """)
+        await db.execute(f"""
+            INSERT INTO {table} (chat_id, {column}, user_id, count)
+            SELECT chat_id, created_at / {bucket_ms}, user_id, COUNT(*) FROM messages
+            WHERE user_id IS NOT NULL
+            GROUP BY chat_id, created_at / {bucket_ms}, user_id
+        """)
+
+async def _migration_summary_buckets(db):
+    # Cached summaries of closed buckets (see _BUCKET_TABLES), numbered like the rollups.
+    # message_count is the rollup count the summary was built from; a
+    # mismatch means messages arrived later and the summary is stale.
+    await db.execute("""
+        CREATE TABLE summary_buckets (
+            chat_id INTEGER NOT NULL,
+            granularity TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            summary TEXT NOT NULL,
+            PRIMARY KEY (chat_id, granularity, bucket)
+        )
+    """)
+
+async def _migration_chat_activity(db):
+    # starter_at: when the bot last broke a silence in the chat (see silence.py)
+    await db.execute("""
+        CREATE TABLE chat_activity (
+            chat_id INTEGER PRIMARY KEY,
+            last_message_at INTEGER NOT NULL,
+            starter_at INTEGER
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        INSERT INTO chat_activity (chat_id, last_message_at)
+        SELECT chat_id, MAX(created_at) FROM messages GROUP BY chat_id
+    """)
+
+async def _migration_chat_type(db):
+    # Telegram chat type ("group", "supergroup", "channel", "private");
+    # unknown for rows written before, filled in by the chat's next message
+    await db.execute("ALTER TABLE chat_activity ADD COLUMN chat_type TEXT")
+
+MIGRATIONS = (
+    _migration_base_schema,      # v1
+    _migration_fts,              # v2
+    _migration_time_indexes,     # v3
+    _migration_compact_storage,  # v4
+    _migration_activity_rollups, # v5
+    _migration_summary_buckets,  # v6
+    _migration_chat_activity,    # v7
+    _migration_chat_type,        # v8
+)
+
+# Migrations that rewrite whole tables; the freed pages are returned to
+# the OS with a VACUUM afterwards
+_VACUUM_AFTER = {4}
+
+async def _migrate():
+    async with _read_conn() as db:
+        cursor = await db.execute("PRAGMA user_version")
+        (version,) = await cursor.fetchone()
+
+    if version > len(MIGRATIONS):
+        logging.warning(f"Database schema v{version} is newer than this code (v{len(MIGRATIONS)})")
+        return
+
+    for number in range(version + 1, len(MIGRATIONS) + 1):
+        async with _write_transaction() as db:
+            # DDL doesn't open a transaction implicitly, do it by hand so a
+            # failed migration leaves the previous version intact
+            await db.execute("BEGIN")
+            await MIGRATIONS[number - 1](db)
+            await db.execute(f"PRAGMA user_version = {number}")
+        logging.info(f"Database migrated to schema v{number}")
+
+    if _VACUUM_AFTER.intersection(range(version + 1, len(MIGRATIONS) + 1)):
+        async with _write_lock:
+            await _writer.execute("VACUUM")
+
+async def init_db():
+    await _open_pool()
+    await _migrate()
+    _start_flusher()
+
+# Row shape returned by the read functions: (username, text, created_at)
+# with created_at as local "YYYY-MM-DD HH:MM:SS", same as before the
+# epoch-ms storage change.
+_ROW_COLUMNS = "u.username, m.text, datetime(m.created_at / 1000, 'unixepoch', 'localtime')"
+
+def _cutoff_ms(timeframe, default=timedelta(0)):
+    deltas = {
+        "1h": timedelta(hours=1),
+        "1d": timedelta(days=1),
+        "1w": timedelta(weeks=1),
+        "1m": timedelta(days=30),
+        "all": timedelta(days=365*10),
+    }
+    delta = deltas.get(timeframe, default)
+    return _now_ms() - int(delta.total_seconds() * 1000)
+
+async def log_message(chat_id, user_id, username, text, reply_to_user_id=None, reply_to_username=None, chat_type=None):
+    created_at = _now_ms()
+    batch = [(
+        chat_id,
+        user_id,
+        username,
+        text,
+        reply_to_user_id,
+        reply_to_username,
+        created_at,
+        chat_type
+    )]
+    async with _write_transaction() as db:
+        await _write_batch(db, batch)
+    hot_tier.add(chat_id, user_id, username, text, created_at)
+    _index_semantic(batch)
 
 async def get_messages(chat_id, timeframe):
-    async with aiosqlite.connect(config.DB_NAME) as db:
-        now = datetime.now()
-        delta = timedelta(0)
-        
-        if timeframe == "1h":
-            delta = timedelta(hours=1)
-        elif timeframe == "1d":
-            delta = timedelta(days=1)
-        elif timeframe == "1w":
-            delta = timedelta(weeks=1)
-        elif timeframe == "1m":
-            delta = timedelta(days=30)
-        elif timeframe == "all":
-            delta = timedelta(days=365*10)
-            
-        cutoff = now - delta
-        
-        cursor = await db.execute("""
-            SELECT username, text, created_at FROM messages
-            WHERE chat_id = ? AND created_at >= ?
-            ORDER BY created_at ASC
+    cutoff = _cutoff_ms(timeframe)
+    rows = hot_tier.get_since(chat_id, cutoff)
+    if rows is not None:
+        return rows
+
+    async with _read_conn() as db:
+        cursor = await db.execute(f"""
+            SELECT {_ROW_COLUMNS} FROM messages m
+            LEFT JOIN users u ON u.user_id = m.user_id
+            WHERE m.chat_id = ? AND m.created_at >= ?
+            ORDER BY m.created_at ASC
         """, (chat_id, cutoff))
             
         rows = await cursor.fetchall()
         return rows
 
-async def search_messages(chat_id, query=None, username=None, limit=50, exclude_user_id=None):
+async def iter_messages(chat_id, timeframe=None, batch_size=None, since_ms=None, until_ms=None):
+    """
+    Stream the messages of a timeframe oldest first, as (username, text,
+    created_at) rows like get_messages, but never more than batch_size rows
+    in memory. Pages are fetched with keyset pagination on (created_at, id),
+    so every page is an index range scan and no reader connection is held
+    while the caller works on the rows.
+    since_ms / until_ms select an explicit [since, until) range instead.
+    """
+    cutoff = _cutoff_ms(timeframe) if since_ms is None else since_ms
+    until = until_ms if until_ms is not None else 2**63 - 1
+    if until_ms is None:
+        rows = hot_tier.get_since(chat_id, cutoff)
+        if rows is not None:
+            for row in rows:
+                yield row
+            return
+
+    batch_size = batch_size or config.DB_PAGE_SIZE
+    last_key = None
+    while True:
+        async with _read_conn() as db:
+            if last_key is None:
+                cursor = await db.execute(f"""
+                    SELECT {_ROW_COLUMNS}, m.created_at, m.id FROM messages m
+                    LEFT JOIN users u ON u.user_id = m.user_id
+                    WHERE m.chat_id = ? AND m.created_at >= ? AND m.created_at < ?
+                    ORDER BY m.created_at, m.id
+                    LIMIT ?
+                """, (chat_id, cutoff, until, batch_size))
+            else:
+                cursor = await db.execute(f"""
+                    SELECT {_ROW_COLUMNS}, m.created_at, m.id FROM messages m
+                    LEFT JOIN users u ON u.user_id = m.user_id
+                    WHERE m.chat_id = ? AND (m.created_at, m.id) > (?, ?) AND m.created_at < ?
+                    ORDER BY m.created_at, m.id
+                    LIMIT ?
+                """, (chat_id, *last_key, until, batch_size))
+            page = await cursor.fetchall()
+
+        for row in page:
+            yield row[:3]
+        if len(page) < batch_size:
+            return
+        last_key = page[-1][3:]
+
+async def _ensure_semantic_loaded(chat_id):
+    """
+    Build the chat's vector matrix from its newest SEMANTIC_MAX_ROWS
+    messages on first use. Vectors are computed in a worker thread; rows
+    committed meanwhile are collected in _semantic_backlog and added after.
+    """
+    if semantic.is_loaded(chat_id):
+        return
+    lock = _semantic_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        if semantic.is_loaded(chat_id):
+            return
+        _semantic_backlog[chat_id] = []
+        try:
+            async with _read_conn() as db:
+                cursor = await db.execute("""
+                    SELECT m.created_at, m.user_id, u.username, m.text FROM messages m
+                    LEFT JOIN users u ON u.user_id = m.user_id
+                    WHERE m.chat_id = ? AND m.text IS NOT NULL
+                    ORDER BY m.id DESC
+                    LIMIT ?
+                """, (chat_id, semantic.max_rows_per_chat))
+                rows = await cursor.fetchall()
+            rows.reverse()
+            matrix = await asyncio.to_thread(embed_many, [row[3] for row in rows], semantic.dim)
+            semantic.load(chat_id, rows, matrix)
+        finally:
+            backlog = _semantic_backlog.pop(chat_id)
+        loaded = set(rows[-len(backlog):]) if backlog else set()
+        for row in backlog:
+            if row not in loaded:
+                semantic.add(chat_id, row)
+
+async def semantic_search(chat_id, query, limit=10, username=None, exclude_user_id=None):
+    """
+    Messages closest in meaning to the query (cosine over local hashed
+    n-gram vectors), best first, as (username, text, created_at) rows.
+    """
+    await _ensure_semantic_loaded(chat_id)
+    # Over-fetch so the filters below still leave enough rows
+    candidates = semantic.search(chat_id, query, limit * 4, min_score=config.SEMANTIC_MIN_SCORE)
+    rows = []
+    for _, (created_at, user_id, name, text) in candidates:
+        if exclude_user_id and user_id == exclude_user_id:
+            continue
+        if username and username.lower() not in (name or "").lower():
+            continue
+        rows.append((name, text, format_ts(created_at)))
+        if len(rows) >= limit:
+            break
+    return rows
+
+def _is_latest_query(query):
+    return not query or query.strip() == "" or query == "LATEST" or query == "LATEST_5"
+
+async def _ranked_search(chat_id, query, username, limit, exclude_user_id, mode):
+    """
+    "semantic": vector index only. "hybrid": keyword (bm25) and semantic
+    result lists fused by reciprocal rank, so messages found by both come
+    first and either list can contribute what the other misses.
+    """
+    semantic_rows = await semantic_search(chat_id, query, limit * 2, username, exclude_user_id)
+    if mode == "semantic":
+        return semantic_rows[:limit]
+
+    keyword_rows = await search_messages(
+        chat_id, query=query, username=username, limit=limit * 2,
+        exclude_user_id=exclude_user_id, mode="keyword"
+    )
+    scores = {}
+    found = {}
+    for ranked in (keyword_rows, semantic_rows):
+        for rank, row in enumerate(ranked):
+            key = (row[1], row[2])
+            scores[key] = scores.get(key, 0.0) + 1.0 / (config.SEARCH_RRF_K + rank + 1)
+            found.setdefault(key, row)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [found[key] for key in best]
+
+async def search_messages(chat_id, query=None, username=None, limit=50, exclude_user_id=None, mode="keyword"):
     """
     Search messages by keywords and/or username within a specific chat.
+
+    mode: "keyword" (FTS5 / bm25), "semantic" (local vector index) or
+    "hybrid" (both, rank-fused). Latest-message lookups ignore the mode.
     """
-    async with aiosqlite.connect(config.DB_NAME) as db:
-        conditions = ["chat_id = ?"]
+    if mode != "keyword" and not _is_latest_query(query):
+        return await _ranked_search(chat_id, query, username, limit, exclude_user_id, mode)
+
+    async with _read_conn() as db:
+        conditions = ["m.chat_id = ?"]
         params = [chat_id]
         
         # 1. Exclude User ID
         if exclude_user_id:
-            conditions.append("user_id != ?")
+            conditions.append("m.user_id != ?")
             params.append(exclude_user_id)
             
         # 2. Handle "LATEST" or Empty Query
-        is_latest_search = not query or query.strip() == "" or query == "LATEST" or query == "LATEST_5"
+        is_latest_search = _is_latest_query(query)
         
         if is_latest_search:
+            rows = hot_tier.latest(chat_id, limit, exclude_user_id)
+            if rows is not None:
+                return rows
+
             where_clause = " WHERE " + " AND ".join(conditions)
             sql = f"""
-                SELECT username, text, created_at FROM messages
+                SELECT {_ROW_COLUMNS} FROM messages m
+                LEFT JOIN users u ON u.user_id = m.user_id
                 {where_clause}
-                ORDER BY id DESC
+                ORDER BY m.id DESC
                 LIMIT ?
             """
             params.append(limit)
@@ -117,21 +785,32 @@ async def search_messages(chat_id, query=None, username=None, limit=50, exclude_
             rows = await cursor.fetchall()
             return rows
 
-        # 3. Normal Keyword Search
-        if query and query.strip():
-            conditions.append("text LIKE ?")
-            params.append(f"%{query}%")
-            
+        # 3. Normal Keyword Search (FTS5, ranked by bm25)
+        match_expr = _fts_query(query)
+        if match_expr is None:
+            return []
+
+        conditions = ["messages_fts MATCH ?", "m.chat_id = ?"]
+        params = [f'chat_id : "{abs(chat_id)}" AND ({match_expr})', chat_id]
+
+        if exclude_user_id:
+            conditions.append("m.user_id != ?")
+            params.append(exclude_user_id)
+
         if username:
-            conditions.append("username LIKE ?")
+            conditions.append("m.user_id IN (SELECT user_id FROM users WHERE username LIKE ?)")
             params.append(f"%{username}%")
         
         where_clause = " AND ".join(conditions)
         
+        # bm25 weights: text counts, the chat_id column is only a filter
         sql = f"""
-            SELECT username, text, created_at FROM messages
+            SELECT {_ROW_COLUMNS}
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            LEFT JOIN users u ON u.user_id = m.user_id
             WHERE {where_clause}
-            ORDER BY created_at DESC
+            ORDER BY bm25(messages_fts, 1.0, 0.0), m.id DESC
             LIMIT ?
         """
         params.append(limit)
@@ -142,13 +821,19 @@ async def search_messages(chat_id, query=None, username=None, limit=50, exclude_
 
 async def get_active_users(chat_id, limit=50):
     """
-    Get a list of unique usernames who have written in the specific chat.
+    Get a list of unique usernames who have written in the specific chat,
+    most recently active first. Served from the daily rollup.
     """
-    async with aiosqlite.connect(config.DB_NAME) as db:
+    async with _read_conn() as db:
         cursor = await db.execute("""
-            SELECT DISTINCT username FROM messages 
-            WHERE chat_id = ? AND username IS NOT NULL AND username != 'Unknown'
-            ORDER BY created_at DESC
+            SELECT u.username FROM (
+                SELECT user_id, MAX(day) AS last_day, SUM(count) AS total FROM activity_daily
+                WHERE chat_id = ?
+                GROUP BY user_id
+            ) a
+            JOIN users u ON u.user_id = a.user_id
+            WHERE u.username IS NOT NULL AND u.username != 'Unknown'
+            ORDER BY a.last_day DESC, a.total DESC
             LIMIT ?
         """, (chat_id, limit))
         
@@ -158,26 +843,110 @@ async def get_active_users(chat_id, limit=50):
 async def get_top_talkers(chat_id, timeframe="1d", limit=5):
     """
     Get top active users in the given timeframe.
+
+    The window [cutoff, now) is split into whole days (activity_daily),
+    the whole hours before the first of them (activity_hourly) and the
+    partial hour at the very start, which is the only part counted from
+    raw messages.
     """
-    async with aiosqlite.connect(config.DB_NAME) as db:
-        now = datetime.now()
-        delta = timedelta(days=1)
-        if timeframe == "1h": delta = timedelta(hours=1)
-        elif timeframe == "1w": delta = timedelta(weeks=1)
-        elif timeframe == "1m": delta = timedelta(days=30)
-        elif timeframe == "all": delta = timedelta(days=3650)
-            
-        cutoff = now - delta
+    async with _read_conn() as db:
+        cutoff = _cutoff_ms(timeframe, default=timedelta(days=1))
+        first_hour = -(-cutoff // HOUR_MS)
+        first_day = -(-cutoff // DAY_MS)
+        hours_end = first_day * 24
         
-        # Top speakers
         cursor = await db.execute("""
-            SELECT username, COUNT(*) as count 
-            FROM messages 
-            WHERE chat_id = ? AND created_at >= ? AND username != 'Unknown' AND username IS NOT NULL
-            GROUP BY username 
-            ORDER BY count DESC 
+            SELECT u.username, t.count FROM (
+                SELECT user_id, SUM(count) AS count FROM (
+                    SELECT user_id, count FROM activity_daily
+                    WHERE chat_id = ? AND day >= ?
+                    UNION ALL
+                    SELECT user_id, count FROM activity_hourly
+                    WHERE chat_id = ? AND hour >= ? AND hour < ?
+                    UNION ALL
+                    SELECT user_id, 1 FROM messages
+                    WHERE chat_id = ? AND created_at >= ? AND created_at < ?
+                )
+                GROUP BY user_id
+            ) t
+            JOIN users u ON u.user_id = t.user_id
+            WHERE u.username != 'Unknown' AND u.username IS NOT NULL
+            ORDER BY t.count DESC 
             LIMIT ?
-        """, (chat_id, cutoff, limit))
+        """, (
+            chat_id, first_day,
+            chat_id, first_hour, hours_end,
+            chat_id, cutoff, first_hour * HOUR_MS,
+            limit
+        ))
         
         rows = await cursor.fetchall()
         return [{"username": r[0], "count": r[1]} for r in rows]
+
+# granularity -> (rollup table, column, rollup buckets per bucket). 8-hour
+# shifts, weeks,
+# 4-week months and 13-month years are epoch-aligned runs of days, so each
+# level nests exactly in the next one.
+_BUCKET_TABLES = {
+    "hour": ("activity_hourly", "hour", 1),
+    "shift": ("activity_hourly", "hour", 8),
+    "day": ("activity_daily", "day", 1),
+    "week": ("activity_daily", "day", 7),
+    "month": ("activity_daily", "day", 28),
+    "year": ("activity_daily", "day", 364),
+}
+BUCKET_MS = {
+    granularity: (HOUR_MS if table == "activity_hourly" else DAY_MS) * per
+    for granularity, (table, _, per) in _BUCKET_TABLES.items()
+}
+
+async def get_bucket_counts(chat_id, granularity, first, last):
+    """Messages per non-empty bucket in [first, last), from the rollups."""
+    table, column, per = _BUCKET_TABLES[granularity]
+    async with _read_conn() as db:
+        cursor = await db.execute(f"""
+            SELECT {column} / {per}, SUM(count) FROM {table}
+            WHERE chat_id = ? AND {column} >= ? AND {column} < ?
+            GROUP BY {column} / {per}
+        """, (chat_id, first * per, last * per))
+        return dict(await cursor.fetchall())
+
+async def get_bucket_summaries(chat_id, granularity, first, last):
+    """Cached summaries in [first, last) as {bucket: (message_count, summary)}."""
+    async with _read_conn() as db:
+        cursor = await db.execute("""
+            SELECT bucket, message_count, summary FROM summary_buckets
+            WHERE chat_id = ? AND granularity = ? AND bucket >= ? AND bucket < ?
+        """, (chat_id, granularity, first, last))
+        return {bucket: (count, summary) for bucket, count, summary in await cursor.fetchall()}
+
+async def save_bucket_summary(chat_id, granularity, bucket, message_count, summary):
+    async with _write_transaction() as db:
+        await db.execute("""
+            INSERT OR REPLACE INTO summary_buckets (chat_id, granularity, bucket, message_count, summary)
+            VALUES (?, ?, ?, ?, ?)
+        """, (chat_id, granularity, bucket, message_count, summary))
+
+async def get_chat_activity(since_ms=0, chat_types=None):
+    """
+    (chat_id, last_message_at, starter_at) of chats active since since_ms,
+    optionally only of the given chat types.
+    """
+    conditions = ["last_message_at >= ?"]
+    params = [since_ms]
+    if chat_types is not None:
+        conditions.append(f"chat_type IN ({', '.join('?' * len(chat_types))})")
+        params.extend(chat_types)
+    async with _read_conn() as db:
+        cursor = await db.execute(f"""
+            SELECT chat_id, last_message_at, starter_at FROM chat_activity
+            WHERE {" AND ".join(conditions)}
+        """, params)
+        return await cursor.fetchall()
+
+async def save_starter_time(chat_id, starter_at=None):
+    async with _write_transaction() as db:
+        await db.execute(
+            "UPDATE chat_activity SET starter_at = ? WHERE chat_id = ?",
+            (starter_at or _now_ms(), chat_id)
+        )
@@ -0,0 +1,90 @@
+import random
+import re
+
+import intent_rules
+import metrics
+
+# Cheap relevance gate in front of the LLM. Runs on every text message
+# after it is logged, with no network calls: the bot identity is fetched
+# once at startup. Ordinary group chatter is dropped here; only direct
+# calls and what the chat's reply policy lets through go on to routing.
+#
+# Policies, from strictest:
+#   mention  - only direct calls (private chat, reply to the bot, @mention, name)
+#   keywords - also explicit requests: a fast-path intent other than chat
+#              ("итоги дня", "топ за неделю") or one of the extra keywords
+#   sampled  - also a random share of the remaining chatter (ambient replies)
+#   all      - every message goes to the router (the old behaviour)
+
+POLICIES = ("mention", "keywords", "sampled", "all")
+
+
+class Gate:
+    def __init__(self, default_policy, chat_policies, sample_rate, keywords, names):
+        for policy in (default_policy, *chat_policies.values()):
+            if policy not in POLICIES:
+                raise ValueError(f"Unknown reply policy {policy!r}, expected one of {POLICIES}")
+        self.default_policy = default_policy
+        self.chat_policies = dict(chat_policies)
+        self.sample_rate = sample_rate
+        self.keywords = tuple(k.lower() for k in keywords)
+        self.names = tuple(n.lower() for n in names)
+        # A name is a call only as an address: "бетон, ..." at the start or
+        # "..., бетон" at the end. "бетон" is also a plain noun ("привезли
+        # бетон на объект"), so a mere occurrence or a prefix doesn't count.
+        alternation = "|".join(re.escape(n) for n in self.names)
+        self._vocative = re.compile(
+            rf"^\W*(?:{alternation})(?!\w)|,\s*(?:{alternation})\W*$", re.IGNORECASE
+        ) if self.names else None
+        self.bot_id = None
+        self.bot_username = None
+
+    def set_identity(self, bot_id, bot_username):
+        self.bot_id = bot_id
+        self.bot_username = bot_username
+
+    def policy(self, chat_id):
+        return self.chat_policies.get(chat_id, self.default_policy)
+
+    def is_direct(self, message, text):
+        if message.chat.type == "private":
+            return True
+        reply = message.reply_to_message
+        if reply is not None and reply.from_user is not None and reply.from_user.id == self.bot_id:
+            return True
+        lowered = text.lower()
+        if self.bot_username and f"@{self.bot_username.lower()}" in lowered:
+            return True
+        return self._vocative is not None and self._vocative.search(lowered) is not None
+
+    def check(self, message, text):
+        """
+        (passed, direct, intent) for a message. intent is the fast-path
+        result of intent_rules.classify (None: ambiguous, ask the LLM),
+        computed once here and passed on to routing. Every decision is
+        counted as gate.<stage>.passed / gate.<stage>.dropped.
+        """
+        direct = self.is_direct(message, text)
+        policy = self.policy(message.chat.id)
+        if not direct and policy == "mention":
+            metrics.incr("gate.mention.dropped")
+            return False, False, None
+
+        intent = intent_rules.classify(text, self.bot_username)
+        if direct:
+            metrics.incr("gate.direct.passed")
+            return True, True, intent
+        if policy == "all":
+            metrics.incr("gate.all.passed")
+            return True, False, intent
+
+        lowered = text.lower()
+        if (intent is not None and intent["action"] != "chat") or any(k in lowered for k in self.keywords):
+            metrics.incr("gate.keywords.passed")
+            return True, False, intent
+        if policy == "sampled" and random.random() < self.sample_rate:
+            metrics.incr("gate.sampled.passed")
+            return True, False, intent
+
+        metrics.incr(f"gate.{policy}.dropped")
+        return False, False, intent
@@ -0,0 +1,136 @@
+import sys
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+# Each cached message is a plain tuple (created_at_ms, user_id, username, text).
+# Rough per-entry cost of the tuple, two ints and deque slot, on top of the strings.
+_ENTRY_OVERHEAD = 120
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def format_ts(created_at):
+    # Same text as db._ROW_COLUMNS produces for created_at
+    return datetime.fromtimestamp(created_at // 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class _ChatBuffer:
+    __slots__ = ("entries", "covered_since", "size")
+
+    def __init__(self, covered_since):
+        self.entries = deque()
+        # Every message of the chat with created_at >= covered_since is in entries
+        self.covered_since = covered_since
+        self.size = 0
+
+
+class HotTier:
+    """
+    Ring buffer of the most recent messages of every chat, filled by the
+    ingest path (db.enqueue_message).
+
+    A chat buffer knows the point in time since which it is complete, so a
+    read can tell whether it may be answered from memory or has to go to
+    SQLite. Buffers are trimmed by age and count, and the total footprint
+    across all chats is capped: when over budget, the oldest messages of the
+    least recently active chats go first.
+    """
+
+    def __init__(self, max_per_chat, max_age_seconds, max_bytes):
+        self.max_per_chat = max_per_chat
+        self.max_age_ms = int(max_age_seconds * 1000)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chats = OrderedDict()  # chat_id -> _ChatBuffer, least recently written first
+        # Nothing before this moment went through add(). Raised whenever a
+        # whole chat buffer is dropped, since its history is then unknown.
+        self._floor = _now_ms()
+
+    def add(self, chat_id, user_id, username, text, created_at):
+        buf = self._chats.get(chat_id)
+        if buf is None:
+            buf = self._chats[chat_id] = _ChatBuffer(self._floor)
+        else:
+            self._chats.move_to_end(chat_id)
+
+        if username is not None:
+            username = sys.intern(username)
+        entry = (created_at, user_id, username, text)
+        size = _ENTRY_OVERHEAD + sys.getsizeof(text) + sys.getsizeof(username)
+        buf.entries.append(entry)
+        buf.size += size
+        self.total_bytes += size
+
+        expire_before = created_at - self.max_age_ms
+        while buf.entries and (
+            len(buf.entries) > self.max_per_chat or buf.entries[0][0] < expire_before
+        ):
+            self._pop_oldest(buf)
+
+        self._enforce_budget()
+
+    def _pop_oldest(self, buf):
+        entry = buf.entries.popleft()
+        size = _ENTRY_OVERHEAD + sys.getsizeof(entry[3]) + sys.getsizeof(entry[2])
+        buf.size -= size
+        self.total_bytes -= size
+        buf.covered_since = entry[0] + 1
+
+    def _enforce_budget(self):
+        while self.total_bytes > self.max_bytes and self._chats:
+            chat_id, buf = next(iter(self._chats.items()))
+            self._pop_oldest(buf)
+            if not buf.entries:
+                del self._chats[chat_id]
+                self._floor = max(self._floor, buf.covered_since)
+
+    def get_since(self, chat_id, cutoff_ms):
+        """
+        Rows (username, text, created_at) newer than cutoff_ms, oldest
+        first, or None if the buffer doesn't reach back that far.
+        """
+        buf = self._chats.get(chat_id)
+        covered_since = buf.covered_since if buf is not None else self._floor
+        if cutoff_ms < covered_since:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if buf is None:
+            return []
+        return [
+            (username, text, format_ts(created_at))
+            for created_at, _, username, text in buf.entries
+            if created_at >= cutoff_ms
+        ]
+
+    def latest(self, chat_id, limit, exclude_user_id=None):
+        """
+        The `limit` newest rows, newest first, or None if the buffer holds
+        fewer than that (older ones may exist only on disk).
+        """
+        buf = self._chats.get(chat_id)
+        rows = []
+        if buf is not None:
+            for created_at, user_id, username, text in reversed(buf.entries):
+                if exclude_user_id and user_id == exclude_user_id:
+                    continue
+                rows.append((username, text, format_ts(created_at)))
+                if len(rows) >= limit:
+                    self.hits += 1
+                    return rows
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "messages": sum(len(buf.entries) for buf in self._chats.values()),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,231 @@
+import re
+
+import metrics
+
+# Local fast path in front of ai_service.detect_intent. Obvious requests
+# ("итоги дня", "топ за неделю", "найди ссылку") and plain greetings are
+# classified with one compiled regex per action; anything ambiguous returns
+# None and goes to the LLM router. Triggers mirror INTENT_SYSTEM_PROMPT.
+
+# Longer messages are usually conversation that merely mentions a trigger
+MAX_CONFIDENT_LENGTH = 90
+
+# A trailing "*" marks a stem: the word may continue with any letters
+SUMMARY_TRIGGERS = [
+    "выжимк*", "итог дня", "подведи итог*", "подытож*",
+    "сводк*", "саммари", "резюмир*", "перескаж*", "о чем говорили",
+    "о чем болтали", "что обсуждали", "что было в чате",
+    "recap", "summar*", "what happened", "what did we discuss",
+]
+ANALYTICS_TRIGGERS = [
+    "кто больше всех", "кто меньше всех", "самый активный", "самые активные",
+    "кого сегодня было слышно",
+    "сколько людей", "сколько человек", "сколько нас", "who talks the most",
+]
+SEARCH_TRIGGERS = [
+    "найди", "поищи", "ищи", "какие новости",
+    "че там писали", "что там писали", "что писал*", "че писал*", "что говорил*",
+    "последнее сообщение", "последние сообщения",
+    "show messages", "messages from", "any updates", "what did",
+]
+
+# Common words that are requests only in context ("итоги дня", "топ за
+# неделю", "покажи статистику"): they count when the message also names a
+# timeframe or starts with an imperative, otherwise the LLM decides
+# ("итоги выборов слышали?", "это просто топ", "вот это новость")
+WEAK_SUMMARY_TRIGGERS = ["итоги", "итогам"]
+WEAK_ANALYTICS_TRIGGERS = ["топ", "активност*", "статистик*", "рейтинг*"]
+WEAK_SEARCH_TRIGGERS = ["найти", "новост*", "ссылк*"]
+IMPERATIVES = [
+    "дай", "дайте", "сделай", "покажи", "скинь", "кинь", "подведи", "расскажи",
+    "выведи", "глянь", "show", "give",
+]
+INFO_TRIGGERS = [
+    "кто ты", "ты кто", "что ты умеешь", "что умеешь", "зачем ты", "зачем ты нужен",
+    "как тебя зовут", "who are you",
+]
+# Chat is only decided when the whole message is one of these
+SMALL_TALK = [
+    "привет*", "ку", "хай", "здаров*", "здравствуй*", "доброе утро", "добрый день",
+    "добрый вечер", "доброй ночи", "спасибо", "спс", "ок", "окей", "ага", "лол",
+    "ахах*", "хах*", "пока", "hello", "hi", "hey", "thanks",
+]
+
+_TIMEFRAMES = (
+    ("all", re.compile(r"вс[её] врем|всю истори|за вс[её]\b|all time|everything")),
+    ("1m", re.compile(r"месяц|month")),
+    ("1w", re.compile(r"недел|week")),
+    ("1h", re.compile(r"(?<!\w)час(?:а|ик)?(?!\w)|hour")),
+    ("1d", re.compile(r"сегодня|(?<!\w)(?:день|дня|сутки|суток)(?!\w)|вчера|today|yesterday|(?<!\w)day")),
+)
+
+_USERNAME_PATTERNS = (
+    re.compile(r"@(\w+)"),
+    re.compile(r"(?:что|че|чё)\s+(?:писал|писала|говорил|говорила|сказал|сказала)\s+(\w+)", re.IGNORECASE),
+    re.compile(r"сообщения\s+от\s+(\w+)", re.IGNORECASE),
+    re.compile(r"what\s+did\s+(\w+)\s+say", re.IGNORECASE),
+    re.compile(r"(?:messages|updates)\s+from\s+(\w+)", re.IGNORECASE),
+)
+
+# Words that carry no search meaning once the trigger is gone
+_FILLER = {
+    "а", "в", "и", "о", "об", "про", "по", "на", "за", "с", "у", "мне", "нам", "пожалуйста",
+    "плиз", "какие", "какой", "что", "че", "чё", "там", "тут", "чате", "чат", "бетон",
+    "from", "any", "the", "me", "about", "say", "in", "of",
+}
+
+_WORD = re.compile(r"\w+")
+
+
+def _trie_regex(words):
+    """
+    Compile trigger words into one alternation shaped like their prefix
+    trie, so shared prefixes ("итоги", "итогам") are matched only once.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word.rstrip("*"):
+            node = node.setdefault(ch, {})
+        node["STEM" if word.endswith("*") else "END"] = True
+
+    def build(node):
+        options = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if len(ch) == 1]
+        if "STEM" in node:
+            options.append(r"\w*")
+        elif "END" in node:
+            options.append("")
+        if len(options) == 1:
+            return options[0]
+        return "(?:" + "|".join(options) + ")"
+
+    return re.compile(r"(?<!\w)" + build(trie) + r"(?!\w)")
+
+
+_RULES = (
+    ("summary", _trie_regex(SUMMARY_TRIGGERS)),
+    ("analytics", _trie_regex(ANALYTICS_TRIGGERS)),
+    ("search", _trie_regex(SEARCH_TRIGGERS)),
+    ("info", _trie_regex(INFO_TRIGGERS)),
+)
+_WEAK_RULES = (
+    ("summary", _trie_regex(WEAK_SUMMARY_TRIGGERS)),
+    ("analytics", _trie_regex(WEAK_ANALYTICS_TRIGGERS)),
+    ("search", _trie_regex(WEAK_SEARCH_TRIGGERS)),
+)
+_IMPERATIVE = _trie_regex(IMPERATIVES)
+_SMALL_TALK = _trie_regex(SMALL_TALK)
+
+
+def _normalize(text):
+    text = text.lower().replace("ё", "е")
+    return " ".join(text.split())
+
+
+def _timeframe(norm, default="1d"):
+    for timeframe, pattern in _TIMEFRAMES:
+        if pattern.search(norm):
+            return timeframe
+    return default
+
+
+def _has_request_context(norm):
+    # An imperative opening the message (optionally after "бетон,") or an explicit timeframe
+    words = [w for w in _WORD.findall(norm) if w != "бетон"]
+    if words and _IMPERATIVE.fullmatch(words[0]):
+        return True
+    return _timeframe(norm, default=None) is not None
+
+
+def _username(text):
+    for pattern in _USERNAME_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return match.group(1)
+    return None
+
+
+def _keywords(norm, trigger, username):
+    rest = trigger.sub(" ", norm)
+    words = [
+        w for w in _WORD.findall(rest)
+        if w not in _FILLER and not _IMPERATIVE.fullmatch(w)
+        and (username is None or w != username.lower())
+    ]
+    return " ".join(words)
+
+
+def _strip_mention(text, bot_username):
+    # "@beton_bot найди ..." is a call to the bot, not a search by author
+    if not bot_username:
+        return text
+    return re.sub(rf"@{re.escape(bot_username)}(?!\w)", " ", text, flags=re.IGNORECASE)
+
+
+def classify(text, bot_username=None):
+    """
+    Intent dict in the detect_intent format if the text is unambiguous,
+    otherwise None (ask the LLM). bot_username (without "@") is ignored
+    wherever it is mentioned.
+    """
+    text = _strip_mention(text, bot_username)
+    norm = _normalize(text)
+    if not norm:
+        return None
+
+    # Greetings / reactions, optionally addressed to the bot
+    bare = " ".join(w for w in _WORD.findall(norm) if w != "бетон")
+    if not bare or _SMALL_TALK.fullmatch(bare):
+        return {"action": "chat"}
+
+    if len(norm) > MAX_CONFIDENT_LENGTH:
+        return None
+
+    matched = [(action, pattern) for action, pattern in _RULES if pattern.search(norm)]
+    if not matched and _has_request_context(norm):
+        matched = [(action, pattern) for action, pattern in _WEAK_RULES if pattern.search(norm)]
+    if len(matched) != 1:
+        return None
+
+    action, pattern = matched[0]
+    if action in ("summary", "analytics"):
+        return {"action": action, "timeframe": _timeframe(norm)}
+    if action == "search":
+        username = _username(text)
+        return {"action": "search", "keywords": _keywords(norm, pattern, username), "username": username}
+    return {"action": action}
+
+
+def record(intent):
+    """Count a classify() result as a fast-path hit / miss and return it."""
+    metrics.incr("intent.fast_path.hit" if intent is not None else "intent.fast_path.miss")
+    return intent
+
+
+def classify_counted(text, bot_username=None):
+    """classify() plus hit / miss counters for the fast path."""
+    return record(classify(text, bot_username))
+
+
+def evaluate(samples, bot_username=None):
+    """
+    Hit rate and accuracy of the fast path on (text, expected_action) or
+    (text, expected_action, expected_fields) samples; a hit is correct
+    when the action and every expected field (username, keywords, ...) match.
+    Accuracy is measured on the hits only: misses go to the LLM anyway.
+    """
+    hits = correct = 0
+    for text, expected_action, *fields in samples:
+        intent = classify(text, bot_username)
+        if intent is None:
+            continue
+        hits += 1
+        expected = fields[0] if fields else {}
+        if intent["action"] == expected_action and all(intent.get(k) == v for k, v in expected.items()):
+            correct += 1
+    return {
+        "total": len(samples),
+        "hits": hits,
+        "hit_rate": hits / len(samples) if samples else 0.0,
+        "accuracy": correct / hits if hits else 0.0,
+    }
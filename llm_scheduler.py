@@ -0,0 +1,273 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import openai
+
+import metrics
+import tokens
+
+# Every LLM call goes through one scheduler: token buckets keep us under
+# the provider's requests-per-minute and tokens-per-minute limits, waiting
+# calls are served by priority, and 429 / 5xx / network errors are retried
+# here with jittered backoff (the client's own retries are turned off).
+
+INTERACTIVE = 0  # direct mentions, replies to the bot, private chats
+SUMMARY = 1      # /summary and other explicit heavy requests
+BACKGROUND = 2   # ambient routing of group chatter, timers
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", SUMMARY: "summary", BACKGROUND: "background"}
+
+_priority = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+
+
+def set_priority(priority):
+    """
+    Priority of LLM calls made from the current task and the tasks it
+    starts afterwards (contextvars are copied into new tasks).
+    """
+    _priority.set(priority)
+
+
+class TokenBucket:
+    def __init__(self, capacity, per_second):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def delay(self, amount):
+        """Seconds until amount is available (0 if it is now)."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.per_second)
+
+    def take(self, amount):
+        self._refill()
+        # amount < 0 gives budget back; the level may go negative when a
+        # correction after the real usage is known exceeds what was left
+        self.level = min(self.capacity, self.level - min(amount, self.capacity))
+
+    def drain(self):
+        self._refill()
+        self.level = min(self.level, 0)
+
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, if it said so."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def _is_retryable(error):
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class LLMScheduler:
+    """
+    Priority queue in front of client.chat.completions.create.
+
+    A call is admitted when it is at the head of the queue (lowest priority
+    number, then arrival order), a concurrency slot is free and both
+    buckets hold enough budget: one request and its estimated tokens
+    (prompt plus max_tokens). The estimate is corrected with the real
+    usage once the response arrives. A 429 pauses admission for every
+    caller until its retry-after has passed.
+    """
+
+    def __init__(self, client, rpm, tpm, max_concurrency, max_retries, backoff_base, backoff_max, default_output_tokens):
+        self.client = client
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.default_output_tokens = default_output_tokens
+        self.in_flight = 0
+        self._queue = []  # heap of (priority, seq, tokens, future)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._timer = None
+
+    def _estimate(self, kwargs):
+        prompt = sum(tokens.estimate_tokens(m.get("content") or "") + 4 for m in kwargs.get("messages", ()))
+        return prompt + kwargs.get("max_tokens", self.default_output_tokens)
+
+    def _record_depth(self):
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                depth[PRIORITY_NAMES[priority]] += 1
+        for name, value in depth.items():
+            metrics.gauge(f"llm.queue.{name}", value)
+        metrics.gauge("llm.in_flight", self.in_flight)
+
+    def _pump(self):
+        """Admit as many queued calls as the limits allow right now."""
+        self._timer = None
+        while self._queue:
+            priority, seq, amount, future = self._queue[0]
+            if future.done():  # caller gave up
+                heapq.heappop(self._queue)
+                continue
+            if self.in_flight >= self.max_concurrency:
+                break
+            wait = max(
+                self._paused_until - time.monotonic(),
+                self.requests.delay(1),
+                self.tokens.delay(amount),
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._pump)
+                break
+            heapq.heappop(self._queue)
+            self.requests.take(1)
+            self.tokens.take(amount)
+            self.in_flight += 1
+            future.set_result(None)
+        self._record_depth()
+
+    async def _acquire(self, priority, seq, amount):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, seq, amount, future))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._pump()
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as we were cancelled: give the slot back
+                self._release()
+            raise
+        metrics.observe(f"llm.queue_wait.{PRIORITY_NAMES[priority]}", time.monotonic() - started)
+
+    def _release(self):
+        self.in_flight -= 1
+        if self._timer is not None:
+            self._timer.cancel()
+        self._pump()
+
+    def _backoff(self, attempt, error):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)  # jitter so retries don't line up
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.backoff_base))
+        return delay
+
+    def _on_error(self, error, attempt, retryable=True):
+        """
+        Decide about a failed attempt whose slot is still held: release
+        it, re-raise if the call is out of retries, else return how long
+        to wait before queueing again.
+        """
+        retry = retryable and _is_retryable(error) and attempt < self.max_retries
+        delay = self._backoff(attempt, error) if retry else 0.0
+        if retry and isinstance(error, openai.RateLimitError):
+            metrics.incr("llm.rate_limited")
+            # The limit is per account: hold everyone back, not just
+            # us. The call queues again right away and, keeping its
+            # seq, is the first one admitted after the pause.
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.requests.drain()
+            delay = 0.0
+        self._release()
+        if not retry:
+            metrics.incr("llm.failures")
+            raise error
+        metrics.incr("llm.retries")
+        logging.warning(f"LLM call failed ({error.__class__.__name__}), retry {attempt + 1}")
+        return delay
+
+    def _settle(self, usage, amount):
+        # Replace the estimate with what the provider actually counted
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if total:
+            self.tokens.take(total - amount)
+
+    async def create(self, **kwargs):
+        """client.chat.completions.create(**kwargs) under the limits."""
+        priority = _priority.get()
+        # Retries keep their place in the queue
+        seq = next(self._seq)
+        amount = self._estimate(kwargs)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, seq, amount)
+            metrics.incr("llm.requests")
+            try:
+                response = await self.client.chat.completions.create(**kwargs)
+            except asyncio.CancelledError:
+                self._release()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._on_error(e, attempt))
+                continue
+
+            self._settle(getattr(response, "usage", None), amount)
+            self._release()
+            return response
+
+    async def stream(self, **kwargs):
+        """
+        Streaming completion under the limits: yields text deltas as they
+        arrive. The slot is held until the stream ends. A failure is only
+        retried before the first delta, later ones are raised.
+        """
+        priority = _priority.get()
+        seq = next(self._seq)
+        amount = self._estimate(kwargs)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, seq, amount)
+            metrics.incr("llm.requests")
+            held = True
+            started = False
+            try:
+                stream = await self.client.chat.completions.create(stream=True, **kwargs)
+                usage = None
+                async for chunk in stream:
+                    # Groq reports usage in x_groq on the last chunk
+                    extra = getattr(chunk, "x_groq", None)
+                    usage = getattr(chunk, "usage", None) or getattr(extra, "usage", None) or usage
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        started = True
+                        yield delta
+                self._settle(usage, amount)
+                return
+            except Exception as e:
+                held = False
+                delay = self._on_error(e, attempt, retryable=not started)
+            finally:
+                if held:
+                    self._release()
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "queued": sum(1 for *_, future in self._queue if not future.done()),
+            "in_flight": self.in_flight,
+            "rpm_left": int(self.requests.level),
+            "tpm_left": int(self.tokens.level),
+        }
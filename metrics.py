@@ -0,0 +1,49 @@
+import math
+from collections import Counter, deque
+
+# In-process counters and latency samples. Cheap enough for the hot path;
+# read with snapshot() (the /stats command) or percentile().
+
+MAX_SAMPLES = 1000  # latency samples kept per name
+
+counters = Counter()
+gauges = {}
+_latencies = {}
+
+
+def incr(name, value=1):
+    counters[name] += value
+
+
+def gauge(name, value):
+    gauges[name] = value
+
+
+def observe(name, seconds):
+    samples = _latencies.get(name)
+    if samples is None:
+        samples = _latencies[name] = deque(maxlen=MAX_SAMPLES)
+    samples.append(seconds)
+
+
+def percentile(name, q):
+    """q-th percentile (0-100) of the recent samples of name, or None."""
+    samples = _latencies.get(name)
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def snapshot():
+    latencies = {
+        name: {
+            "n": len(samples),
+            "p50": percentile(name, 50),
+            "p95": percentile(name, 95),
+        }
+        for name, samples in _latencies.items()
+        if samples
+    }
+    return {"counters": dict(counters), "gauges": dict(gauges), "latency": latencies}
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from datetime import datetime
+
+import ai_service
+import config
+import db
+
+# Long-window summaries built from cached per-bucket digests. A closed
+# bucket is summarized once and stored in summary_buckets; a request then
+# only summarizes the open part from raw messages and merges it with the
+# cached digests. A digest is reused only while its message count still
+# matches the rollups, so late messages make it stale (db._write_batch also
+# deletes hour / day digests right away).
+#
+# A window with few messages (config.SUMMARY_RAW_MAX_MESSAGES by the
+# rollups) is cheaper to summarize raw: one or two map calls, no merges.
+#
+# Long windows are covered with coarse buckets first and finer ones only
+# for the recent tail, so a request merges a handful of digests instead of
+# one per active day. Coarse levels are calendar-free: a "month" is 4
+# weeks and a "year" 13 such months, so every level nests in the next one
+# (see db._BUCKET_TABLES). A coarse digest is merged from the cached
+# digests of its sub-buckets when they are all there, otherwise it is
+# built from raw messages, where token packing puts many quiet days into
+# one map call.
+
+# timeframe -> (levels coarse to fine, window length in ms). A day is 3
+# closed 8-hour shifts plus the open one: one merge of four parts
+_PLANS = {
+    "1d": (("shift",), db.DAY_MS),
+    "1w": (("day",), 7 * db.DAY_MS),
+    "1m": (("week", "day"), 30 * db.DAY_MS),
+    "all": (("year", "month", "week", "day"), 3650 * db.DAY_MS),
+}
+
+_FINER = {"year": "month", "month": "week", "week": "day", "day": "shift"}
+
+_LABEL_FORMATS = {"hour": "%Y-%m-%d %H:00", "shift": "%Y-%m-%d %H:00", "day": "%Y-%m-%d"}
+
+
+def _bucket_ms(granularity):
+    return db.BUCKET_MS[granularity]
+
+
+def _label(granularity, bucket):
+    start = bucket * _bucket_ms(granularity) / 1000
+    fmt = _LABEL_FORMATS.get(granularity)
+    if fmt:
+        return datetime.fromtimestamp(start).strftime(fmt)
+    end = start + _bucket_ms(granularity) / 1000 - 1
+    return f"{datetime.fromtimestamp(start):%Y-%m-%d} — {datetime.fromtimestamp(end):%Y-%m-%d}"
+
+
+def _valid(counts, cached):
+    """{bucket: digest} of the cached digests whose message count still matches."""
+    return {
+        bucket: cached[bucket][1]
+        for bucket, count in counts.items()
+        if bucket in cached and cached[bucket][0] == count
+    }
+
+
+async def _from_sub_digests(chat_id, granularity, bucket):
+    """Merge the cached digests of a bucket's sub-buckets, None if any is missing."""
+    finer = _FINER.get(granularity)
+    if finer is None:
+        return None
+    per = _bucket_ms(granularity) // _bucket_ms(finer)
+    first, last = bucket * per, (bucket + 1) * per
+    counts = await db.get_bucket_counts(chat_id, finer, first, last)
+    digests = _valid(counts, await db.get_bucket_summaries(chat_id, finer, first, last))
+    if not counts or len(digests) != len(counts):
+        return None
+    if len(digests) == 1:
+        return next(iter(digests.values()))
+    parts = [f"[{_label(finer, sub)}]\n{digests[sub]}" for sub in sorted(digests)]
+    return await ai_service.reduce_summaries(parts)
+
+
+async def _closed_digest(chat_id, granularity, bucket, count):
+    """Summarize one closed bucket and cache it. None if that failed."""
+    digest = await _from_sub_digests(chat_id, granularity, bucket)
+    complete = digest is not None
+    if digest is None:
+        bucket_ms = _bucket_ms(granularity)
+        rows = db.iter_messages(chat_id, since_ms=bucket * bucket_ms, until_ms=(bucket + 1) * bucket_ms)
+        digest, complete = await ai_service.digest_messages(rows)
+    if digest and complete:
+        await db.save_bucket_summary(chat_id, granularity, bucket, count, digest)
+    return digest
+
+
+async def _level_digests(chat_id, granularity, first, last, slots):
+    """
+    Digests of the non-empty closed buckets in [first, last) of one level:
+    ({bucket: digest}, number of non-empty buckets).
+    """
+    # Counts are read before the digests are built: a message landing in
+    # between leaves a mismatching count, and the digest is redone next time
+    counts = await db.get_bucket_counts(chat_id, granularity, first, last)
+    digests = _valid(counts, await db.get_bucket_summaries(chat_id, granularity, first, last))
+    missing = sorted(bucket for bucket in counts if bucket not in digests)
+
+    async def build(bucket):
+        async with slots:
+            return await _closed_digest(chat_id, granularity, bucket, counts[bucket])
+
+    for bucket, digest in zip(missing, await asyncio.gather(*(build(b) for b in missing))):
+        if digest:
+            digests[bucket] = digest
+    logging.info(
+        f"Summary {chat_id}/{granularity}: {len(counts) - len(missing)} cached, "
+        f"{len(missing)} built, {len(counts) - len(digests)} failed"
+    )
+    return digests, len(counts)
+
+
+async def summarize_timeframe(chat_id, timeframe, on_delta=None):
+    """
+    (summary, complete) of the chat for a timeframe; the summary is None if
+    there were no messages. complete is False when any part failed, so the
+    caller doesn't cache failure replies or partial summaries.
+    Timeframes without a bucket plan (1h) are summarized from raw messages.
+    The final LLM call is streamed into on_delta (see ai_service._complete).
+    """
+    plan = _PLANS.get(timeframe)
+    if plan is None:
+        return await ai_service.summarize_messages(db.iter_messages(chat_id, timeframe), on_delta)
+    levels, span_ms = plan
+
+    now = db._now_ms()
+    coarsest = _bucket_ms(levels[0])
+    cursor = (now - span_ms) // coarsest * coarsest
+
+    days = await db.get_bucket_counts(chat_id, "day", cursor // db.DAY_MS, now // db.DAY_MS + 1)
+    if sum(days.values()) <= config.SUMMARY_RAW_MAX_MESSAGES:
+        return await ai_service.summarize_messages(db.iter_messages(chat_id, since_ms=cursor), on_delta)
+    slots = asyncio.Semaphore(config.SUMMARY_CONCURRENCY)
+    parts = []
+    failed = total = 0
+    for granularity in levels:
+        bucket_ms = _bucket_ms(granularity)
+        first, last = cursor // bucket_ms, now // bucket_ms
+        if first >= last:
+            continue
+        digests, non_empty = await _level_digests(chat_id, granularity, first, last, slots)
+        total += non_empty
+        failed += non_empty - len(digests)
+        parts.extend(f"[{_label(granularity, bucket)}]\n{digests[bucket]}" for bucket in sorted(digests))
+        cursor = last * bucket_ms
+
+    open_rows = db.iter_messages(chat_id, since_ms=cursor)
+    open_digest, open_complete = await ai_service.digest_messages(open_rows)
+    total += 1
+    if not open_complete:
+        failed += 1
+    if open_digest:
+        parts.append(f"[{_label(levels[-1], cursor // _bucket_ms(levels[-1]))} — сейчас]\n{open_digest}")
+    if not parts:
+        return (None, True) if failed == 0 else (ai_service.SUMMARY_FAILED, False)
+
+    if len(parts) == 1:
+        result = parts[0].split("\n", 1)[1]
+    else:
+        result = await ai_service.reduce_summaries(parts, on_delta)
+    if failed:
+        result += ai_service.failure_note(failed, total, unit="периодов")
+    return result, failed == 0
@@ -0,0 +1,145 @@
+import re
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Local "semantic" vectors: hashed word and character-trigram features.
+# Trigrams make different forms of the same Russian word ("деплой",
+# "деплоя", "задеплоили") land close to each other, which plain keyword
+# search misses. Everything is computed in-process, no embedding service.
+
+_WORD = re.compile(r"\w+")
+_TRIGRAM_WEIGHT = 0.5
+
+
+def _features(text):
+    for word in _WORD.findall(text.lower()):
+        # Short words are mostly prepositions and particles
+        if len(word) < 3:
+            continue
+        yield word, 1.0
+        padded = f"<{word}>"
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3], _TRIGRAM_WEIGHT
+
+
+def embed(text, dim):
+    """L2-normalized hashed feature vector of a text (float32, shape (dim,))."""
+    vec = np.zeros(dim, dtype=np.float32)
+    for feature, weight in _features(text):
+        h = zlib.crc32(feature.encode("utf-8"))
+        # The top bit picks the sign so colliding features tend to cancel out
+        vec[h % dim] += weight if h & 0x80000000 else -weight
+    # Sublinear term frequency: long messages and floods don't dominate
+    vec = np.sign(vec) * np.log1p(np.abs(vec))
+    norm = np.linalg.norm(vec)
+    if norm > 0:
+        vec /= norm
+    return vec
+
+
+def embed_many(texts, dim):
+    """Stacked vectors of many texts, shape (len(texts), dim)."""
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        matrix[i] = embed(text, dim)
+    return matrix
+
+
+class _ChatVectors:
+    """
+    Message vectors of one chat and the rows they belong to. Grows by
+    doubling up to max_rows, then works as a ring overwriting the oldest.
+    """
+
+    __slots__ = ("matrix", "rows", "max_rows", "next_slot", "count")
+
+    def __init__(self, dim, max_rows, initial_rows=256):
+        self.matrix = np.zeros((min(initial_rows, max_rows), dim), dtype=np.float32)
+        self.rows = []
+        self.max_rows = max_rows
+        self.next_slot = 0
+        self.count = 0
+
+    def add(self, vec, row):
+        if self.count == len(self.matrix) and self.count < self.max_rows:
+            grown = np.zeros((min(self.count * 2, self.max_rows), self.matrix.shape[1]), dtype=np.float32)
+            grown[:self.count] = self.matrix
+            self.matrix = grown
+        self.matrix[self.next_slot] = vec
+        if self.next_slot < len(self.rows):
+            self.rows[self.next_slot] = row
+        else:
+            self.rows.append(row)
+        self.count = min(self.count + 1, self.max_rows)
+        self.next_slot = (self.next_slot + 1) % len(self.matrix) if self.count == self.max_rows else self.count
+
+
+class SemanticIndex:
+    """
+    Per-chat matrices of message vectors for cosine top-k search.
+
+    A chat is loaded lazily on its first search (see db.semantic_search) and
+    then kept up to date by the ingest path. Only the newest
+    max_rows_per_chat messages of a chat are indexed, and only max_chats
+    chats stay loaded, least recently searched evicted first.
+    Rows are (created_at_ms, user_id, username, text) tuples.
+    """
+
+    def __init__(self, dim, max_rows_per_chat, max_chats):
+        self.dim = dim
+        self.max_rows_per_chat = max_rows_per_chat
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> _ChatVectors
+
+    def is_loaded(self, chat_id):
+        return chat_id in self._chats
+
+    def load(self, chat_id, rows, matrix):
+        """Install a chat from rows (oldest first) and their embed_many() matrix."""
+        chat = _ChatVectors(self.dim, self.max_rows_per_chat, initial_rows=max(256, len(rows)))
+        for row, vec in zip(rows[-self.max_rows_per_chat:], matrix[-self.max_rows_per_chat:]):
+            chat.add(vec, row)
+        self._chats[chat_id] = chat
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    def add(self, chat_id, row):
+        """Index a freshly ingested message if its chat is loaded."""
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.add(embed(row[3], self.dim), row)
+
+    def search(self, chat_id, query, k, min_score=0.0):
+        """
+        Up to k (score, row) pairs with the highest cosine similarity to
+        the query, best first.
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.count == 0:
+            return []
+        self._chats.move_to_end(chat_id)
+
+        query_vec = embed(query, self.dim)
+        if not query_vec.any():
+            return []
+
+        # Rows are unit vectors, so the dot product is the cosine
+        scores = chat.matrix[:chat.count] @ query_vec
+        k = min(k, chat.count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (float(scores[i]), chat.rows[i])
+            for i in top
+            if scores[i] > min_score
+        ]
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "vectors": sum(chat.count for chat in self._chats.values()),
+            "bytes": sum(chat.matrix.nbytes for chat in self._chats.values()),
+        }
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import sys
+
+from aiogram import Bot
+from aiohttp import web
+
+import config
+
+# Supervisor + worker processes, one asyncio loop per CPU core.
+#
+# The supervisor only receives updates (long polling or webhook) and
+# forwards the raw JSON to the shard that owns the chat:
+# abs(chat_id) % SHARDS. A shard is a full bot process (bot.startup) with
+# its own SQLite file, so every message, rollup, cached summary and search
+# index of a chat lives in exactly one database and all analytics of the
+# chat stay exact. Each shard feeds its updates one by one, which keeps
+# per-chat order; the slow work is done by the shard's chat queue anyway.
+#
+#   SHARDS=4 python bot.py              # start
+#   python sharding.py split 4          # one-off: split an existing chat_history.db
+
+# Update types whose payload carries a chat
+_CHAT_UPDATE_TYPES = ("message", "edited_message", "channel_post", "edited_channel_post")
+
+
+def shard_of(chat_id, shards):
+    return abs(chat_id) % shards
+
+
+def shard_db_name(index, db_name=None):
+    root, ext = os.path.splitext(db_name or config.DB_NAME)
+    return f"{root}.shard{index}{ext}"
+
+
+def _chat_id(update):
+    for key in _CHAT_UPDATE_TYPES:
+        payload = update.get(key)
+        if payload:
+            return payload["chat"]["id"]
+    return None
+
+
+# --- worker side ---
+
+def _worker_main(index, updates):
+    # Runs in a fresh (spawned) interpreter. The database path is read at
+    # connect time, so it can still be set here (LLM limits: Supervisor.start)
+    config.DB_NAME = shard_db_name(index)
+    # spawn re-imported bot.py as __mp_main__, and its basicConfig already
+    # set up the root logger: without force=True the prefix is ignored
+    logging.basicConfig(
+        level=logging.INFO, format=f"[shard {index}] %(levelname)s:%(name)s:%(message)s", force=True
+    )
+    try:
+        asyncio.run(_worker(updates))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker(updates):
+    import bot
+
+    tg_bot, dp = await bot.startup()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            try:
+                await dp.feed_raw_update(tg_bot, update)
+            except Exception as e:
+                logging.error(f"Update {update.get('update_id')} failed: {e}")
+    finally:
+        await bot.shutdown()
+
+
+# --- supervisor side ---
+
+class Supervisor:
+    def __init__(self, shards, queue_size):
+        context = multiprocessing.get_context("spawn")
+        self.shards = shards
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.processes = [
+            context.Process(target=_worker_main, args=(i, self.queues[i]), name=f"shard-{i}")
+            for i in range(shards)
+        ]
+
+    def start(self):
+        # Provider limits are per account, split them between the shards.
+        # Through the environment: spawn re-imports the __main__ module
+        # (bot.py, and with it ai_service.llm) before _worker_main runs,
+        # so assigning to config in the worker would be too late
+        os.environ["LLM_RPM"] = str(max(1, config.LLM_RPM // self.shards))
+        os.environ["LLM_TPM"] = str(max(1, config.LLM_TPM // self.shards))
+        for process in self.processes:
+            process.start()
+
+    async def route(self, update):
+        chat_id = _chat_id(update)
+        target = self.queues[shard_of(chat_id, self.shards) if chat_id is not None else 0]
+        try:
+            target.put_nowait(update)
+        except queue.Full:
+            # Backpressure: the shard is behind, wait for room without blocking the loop
+            await asyncio.get_running_loop().run_in_executor(None, target.put, update)
+
+    def stop(self, timeout=30):
+        for q in self.queues:
+            q.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    async def poll(self, tg_bot):
+        await tg_bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                batch = await tg_bot.get_updates(
+                    offset=offset, timeout=30, allowed_updates=list(_CHAT_UPDATE_TYPES)
+                )
+            except Exception as e:
+                logging.error(f"getUpdates failed: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in batch:
+                await self.route(update.model_dump(mode="json", exclude_none=True))
+                offset = update.update_id + 1
+
+    async def serve_webhook(self, tg_bot):
+        if not config.WEBHOOK_SECRET:
+            raise RuntimeError("WEBHOOK_SECRET is required for the sharded webhook mode")
+
+        async def handle(request):
+            if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.WEBHOOK_SECRET:
+                return web.Response(status=401)
+            await self.route(await request.json())
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_post(config.WEBHOOK_PATH, handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT).start()
+        if config.WEBHOOK_URL:
+            await tg_bot.set_webhook(
+                f"{config.WEBHOOK_URL}{config.WEBHOOK_PATH}",
+                secret_token=config.WEBHOOK_SECRET,
+                allowed_updates=list(_CHAT_UPDATE_TYPES)
+            )
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+async def _supervise(supervisor):
+    tg_bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    try:
+        if config.BOT_MODE == "webhook":
+            await supervisor.serve_webhook(tg_bot)
+        else:
+            await supervisor.poll(tg_bot)
+    finally:
+        await tg_bot.session.close()
+
+
+def run():
+    logging.basicConfig(level=logging.INFO)
+    supervisor = Supervisor(config.SHARDS, config.SHARD_QUEUE_SIZE)
+    supervisor.start()
+    logging.info(f"🧩 SUPERVISOR STARTED {config.SHARDS} SHARDS ({config.BOT_MODE})")
+    try:
+        asyncio.run(_supervise(supervisor))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+
+# --- one-off migration ---
+
+# Tables keyed by chat_id; messages_fts follows messages through its triggers
+_CHAT_TABLES = ("messages", "activity_hourly", "activity_daily", "summary_buckets", "chat_activity")
+
+
+def split_database(shards, db_name=None):
+    """
+    Copy an existing single-process database into per-shard files, each
+    keeping only the chats it owns. The source file is left untouched.
+    Open the source with the bot once beforehand so it is fully migrated.
+    """
+    source = db_name or config.DB_NAME
+    src = sqlite3.connect(source)
+    for index in range(shards):
+        target = shard_db_name(index, source)
+        conn = sqlite3.connect(target)
+        try:
+            # backup() also picks up pages still sitting in the WAL
+            src.backup(conn)
+            for table in _CHAT_TABLES:
+                conn.execute(f"DELETE FROM {table} WHERE abs(chat_id) % ? != ?", (shards, index))
+            conn.commit()
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        print(f"{target}: shard {index} of {shards}")
+    src.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "split":
+        split_database(int(sys.argv[2]))
+    else:
+        run()
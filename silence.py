@@ -0,0 +1,108 @@
+import asyncio
+import heapq
+import logging
+import time
+
+import metrics
+
+
+class SilenceScheduler:
+    """
+    Calls on_silence(chat_id) once a chat has been quiet for `threshold`
+    seconds. It fires once per silence: the chat is re-armed only by its
+    next message.
+
+    Deadlines live in a dict, and a heap holds one (due, chat_id) entry
+    per armed chat. A heap entry may be older than the dict value (lazy
+    invalidation): a message only moves the dict value, which is O(1).
+    A popped entry whose chat got newer activity is pushed back with the
+    real deadline, which is O(log n). The loop sleeps until the earliest
+    entry instead of polling.
+    """
+
+    def __init__(self, threshold, on_silence, max_idle=None, clock=time.time):
+        self.threshold = threshold
+        self.on_silence = on_silence
+        # Chats quiet for longer than this when restored are left alone
+        self.max_idle = max_idle
+        self.clock = clock
+        self.fired = 0
+        self._deadlines = {}  # chat_id -> due, epoch seconds
+        self._heap = []  # (due, chat_id), due <= _deadlines[chat_id]
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def touch(self, chat_id, at=None):
+        """Activity in a chat: its deadline moves to at + threshold."""
+        self._arm(chat_id, (self.clock() if at is None else at) + self.threshold)
+
+    def restore(self, chat_id, last_activity, starter_at=None):
+        """Arm a chat from persisted state (epoch seconds)."""
+        if starter_at is not None and starter_at >= last_activity:
+            return  # this silence was already answered
+        if self.max_idle is not None and self.clock() - last_activity > self.max_idle:
+            return
+        self._arm(chat_id, last_activity + self.threshold)
+
+    def _arm(self, chat_id, due):
+        current = self._deadlines.get(chat_id)
+        if current is not None:
+            # The heap entry stays, it is fixed up when it comes due
+            self._deadlines[chat_id] = max(current, due)
+            return
+        self._deadlines[chat_id] = due
+        heapq.heappush(self._heap, (due, chat_id))
+        if self._heap[0][1] == chat_id:
+            # New earliest deadline, the loop may be sleeping past it
+            self._wakeup.set()
+
+    def _pop_due(self, now):
+        due_chats = []
+        while self._heap and self._heap[0][0] <= now:
+            due, chat_id = heapq.heappop(self._heap)
+            deadline = self._deadlines[chat_id]
+            if deadline > due:
+                heapq.heappush(self._heap, (deadline, chat_id))
+                continue
+            del self._deadlines[chat_id]
+            due_chats.append(chat_id)
+        return due_chats
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            for chat_id in self._pop_due(self.clock()):
+                self.fired += 1
+                metrics.incr("silence.fired")
+                try:
+                    self.on_silence(chat_id)
+                except Exception as e:
+                    logging.error(f"Silence callback failed for chat {chat_id}: {e}")
+            metrics.gauge("silence.armed", len(self._deadlines))
+
+            timeout = self._heap[0][0] - self.clock() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "armed": len(self._deadlines),
+            "heap": len(self._heap),
+            "next_in": round(self._heap[0][0] - self.clock(), 1) if self._heap else None,
+            "fired": self.fired,
+        }
@@ -10,6 +10,61 @@ os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY", "mock_key")
 os.environ["TELEGRAM_BOT_TOKEN"] = os.getenv("TELEGRAM_BOT_TOKEN", "mock_token")
 
 import ai_service
+import intent_rules
+
+# Labeled phrases for the local fast path (intent_rules.classify)
+FAST_PATH_CASES = [
+    ("Привет!", "chat"),
+    ("ку", "chat"),
+    ("Бетон, привет", "chat"),
+    ("спасибо", "chat"),
+    ("итоги дня", "summary"),
+    ("Сделай выжимку за неделю", "summary"),
+    ("О чем говорили сегодня?", "summary"),
+    ("Дай сводку за час", "summary"),
+    ("саммари за все время", "summary"),
+    ("Кто больше всех пишет?", "analytics"),
+    ("Топ 10 за месяц", "analytics"),
+    ("Покажи статистику активности", "analytics"),
+    ("Сколько людей в чате?", "analytics"),
+    ("Какие новости?", "search"),
+    ("Найди ссылку на документацию", "search"),
+    ("Что писал Рустам?", "search", {"username": "Рустам"}),
+    ("скинь последнее сообщение", "search"),
+    ("Кто ты?", "info"),
+    ("Что ты умеешь?", "info"),
+    ("Как тебя зовут?", "info"),
+    ("В итоге я так и не понял, кто прав", "chat"),
+    ("Найди итоги вчерашнего созвона", "search"),
+    ("А вы видели, что вчера случилось с сервером?", "chat"),
+    ("Ну и погодка сегодня", "chat"),
+    # Trigger words in plain chatter must not be decided locally
+    ("Это просто топ", "chat"),
+    ("итоги выборов слышали?", "chat"),
+    ("скинь фотку с отпуска", "chat"),
+    ("Где найти хорошего врача?", "chat"),
+    ("вот это новость", "chat"),
+    # The bot's own @mention is a call, not the author to search for
+    ("@beton_bot найди ссылку на деплой", "search", {"username": None, "keywords": "ссылку деплой"}),
+    ("@beton_bot что писал @ivan", "search", {"username": "ivan", "keywords": ""}),
+    ("@Beton_Bot итоги дня", "summary", {"timeframe": "1d"}),
+]
+
+def test_fast_path():
+    """Hit rate and accuracy of the rule-based fast path (no API calls)."""
+    report = intent_rules.evaluate(FAST_PATH_CASES, bot_username="beton_bot")
+    print(
+        f"Fast path: {report['hits']}/{report['total']} decided locally "
+        f"(hit rate {report['hit_rate']:.0%}), accuracy {report['accuracy']:.0%}"
+    )
+    assert report["accuracy"] >= 0.95
+    # Cases with expected fields must be decided locally and exactly
+    for text, expected_action, *fields in FAST_PATH_CASES:
+        if fields:
+            intent = intent_rules.classify(text, bot_username="beton_bot")
+            assert intent is not None and intent["action"] == expected_action, text
+            for key, value in fields[0].items():
+                assert intent.get(key) == value, (text, key, intent.get(key))
 
 async def test_intent_detection():
     """Test various intent detection scenarios."""
@@ -60,6 +115,8 @@ async def test_intent_detection():
     print("Testing complete!")
 
 if __name__ == "__main__":
+    test_fast_path()
+
     # Check if API key is set
     if not os.getenv("GROQ_API_KEY") and not os.getenv("OPENAI_API_KEY"):
         print("⚠️  GROQ_API_KEY or OPENAI_API_KEY not set. This test requires a valid API key.")
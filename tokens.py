@@ -0,0 +1,42 @@
+import math
+import re
+
+# Local token count estimate, no tokenizer download. Calibrated on the
+# Llama 3 tokenizer the Groq models use: English words average ~4 chars
+# per token, Russian ones ~3 (Cyrillic merges are rarer in the vocab),
+# digits go in groups of up to 3. Errs on the high side so chunks built
+# from it don't overflow the context window.
+
+CHARS_PER_TOKEN_LATIN = 4.0
+CHARS_PER_TOKEN_CYRILLIC = 3.0
+DIGITS_PER_TOKEN = 3
+
+_RUNS = re.compile(
+    r"(?P<cyr>[\u0400-\u04ff]+)"
+    r"|(?P<lat>[A-Za-z]+)"
+    r"|(?P<num>\d+)"
+    r"|(?P<space>\s+)"
+    r"|(?P<other>.)",
+    re.DOTALL,
+)
+
+
+def estimate_tokens(text):
+    """Approximate number of tokens in text."""
+    tokens = 0
+    for match in _RUNS.finditer(text):
+        kind = match.lastgroup
+        run = match.group()
+        if kind == "cyr":
+            tokens += math.ceil(len(run) / CHARS_PER_TOKEN_CYRILLIC)
+        elif kind == "lat":
+            tokens += math.ceil(len(run) / CHARS_PER_TOKEN_LATIN)
+        elif kind == "num":
+            tokens += math.ceil(len(run) / DIGITS_PER_TOKEN)
+        elif kind == "space":
+            # Spaces are glued to the next word; only line breaks cost a token
+            tokens += run.count("\n")
+        else:
+            # Punctuation is one token; emoji and other symbols take one per UTF-8 pair of bytes
+            tokens += max(1, len(run.encode("utf-8")) // 2)
+    return tokens